@@ -1,13 +1,24 @@
 #imports
-from collections import defaultdict, Counter
-from contextlib import closing
+from collections import defaultdict, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pickle
 import hashlib
 from pathlib import Path
-from google.cloud import storage
 import itertools
+import threading
+import shutil
+import mmap
 import os
-import io
+import time
+import numpy as np
+import posting_codec
+try:
+    from metrics import timer, count
+except ImportError:
+    # the index builder ships this module without metrics.py
+    from contextlib import nullcontext as timer
+    def count(name, value=1, **labels):
+        pass
 
 
 
@@ -19,10 +30,52 @@ import io
 BLOCK_SIZE = 1999998
 
 # --- Reading/Writing params --- #
-TUPLE_SIZE = 6
-TF_MASK = 2 ** 16 - 1
+TUPLE_SIZE = posting_codec.TUPLE_SIZE
+TF_MASK = posting_codec.TF_MASK
 NUM_BUCKETS = 124
 
+# --- Score bounds --- #
+# number of postings summarized by one entry of InvertedIndex.block_max
+BLOCK_POSTINGS = 128
+
+# --- Impact-ordered postings --- #
+# normalized tf-idf scores are quantized to 1..IMPACT_LEVELS
+IMPACT_LEVELS = 255
+
+# --- Posting block cache --- #
+# RAM budget of the process-wide block cache, and an optional local directory used as a second (disk) tier
+CACHE_MAX_BYTES = int(os.environ.get('IR_CACHE_MAX_BYTES', 512 * 2 ** 20))
+CACHE_DIR = os.environ.get('IR_CACHE_DIR')
+CACHE_DISK_MAX_BYTES = int(os.environ.get('IR_CACHE_DISK_MAX_BYTES', 8 * 2 ** 30))
+
+# --- Decoded posting cache --- #
+# RAM budget of the process-wide cache of decoded posting arrays (0 disables it), width of its frequency sketch,
+# and an optional JSON file of {ii_name: [terms]} pinned in the cache at startup
+POSTING_CACHE_MAX_BYTES = int(os.environ.get('IR_POSTING_CACHE_MAX_BYTES', 256 * 2 ** 20))
+POSTING_SKETCH_WIDTH = 2 ** 16
+PINNED_TERMS = os.environ.get('IR_PINNED_TERMS')
+
+# --- Range reads --- #
+# fetch only the bytes of the requested postings (in pages of RANGE_PAGE_SIZE) instead of whole posting files
+RANGE_READS = os.environ.get('IR_RANGE_READS', '0') == '1'
+RANGE_PAGE_SIZE = int(os.environ.get('IR_RANGE_PAGE_SIZE', 64 * 2 ** 10))
+
+# --- Storage backend --- #
+# local directory laid out like the bucket ({ii_name}/{f_name}, {base_dir}/{name}.pkl)
+INDEX_DIR = os.environ.get('IR_INDEX_DIR')
+# one of 'gcs', 'local' or 'mmap', defaults to 'local' when IR_INDEX_DIR is set
+STORAGE_BACKEND = os.environ.get('IR_STORAGE_BACKEND', 'local' if INDEX_DIR else 'gcs')
+# downloads of whole files (indexes, pr.json, titles.json) are made in chunks, so they can resume
+DOWNLOAD_CHUNK_SIZE = 64 * 2 ** 20
+
+# --- Uploads --- #
+# posting files uploaded in the background at once (a pool shared by all writers of the process), files a writer may
+# have waiting for upload before write() blocks, and attempts per upload, retried after UPLOAD_BACKOFF * 2 ** attempt s
+UPLOAD_WORKERS = int(os.environ.get('IR_UPLOAD_WORKERS', 8))
+UPLOAD_QUEUE = int(os.environ.get('IR_UPLOAD_QUEUE', 16))
+UPLOAD_RETRIES = int(os.environ.get('IR_UPLOAD_RETRIES', 3))
+UPLOAD_BACKOFF = 1.0
+
 
 
 #######################################################################################################################
@@ -40,20 +93,471 @@ def token2bucket_id(token):
 
 
 
+#######################################################################################################################
+################################################## BlockCache Class ###################################################
+
+
+# byte-budgeted LRU of posting files, shared by all readers of the process
+class BlockCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, cache_dir=CACHE_DIR, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        # key -> bytes, least recently used first
+        self._blocks = OrderedDict()
+        self._size = 0
+        # key -> size of the file in the disk tier, least recently used first
+        self._disk_blocks = OrderedDict()
+        self._disk_size = 0
+        self._dir = None
+        if cache_dir:
+            self._dir = Path(cache_dir)
+            self._dir.mkdir(parents=True, exist_ok=True)
+            for path in sorted(self._dir.glob('*.blk'), key=lambda p: p.stat().st_mtime):
+                self._disk_blocks[path.stem] = path.stat().st_size
+                self._disk_size += path.stat().st_size
+        # counters used to size the cache
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+
+    # get a block from RAM or disk, calling loader() on a miss
+    def get_or_load(self, key, loader):
+        b = self.get(key)
+        if b is None:
+            b = loader()
+            self.put(key, b)
+        return b
+
+
+    def get(self, key):
+        with self._lock:
+            b = self._blocks.get(key)
+            if b is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return b
+        b = self._read_disk(key)
+        with self._lock:
+            if b is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, b, to_disk=False)
+        return b
+
+
+    def put(self, key, b, to_disk=True):
+        if len(b) > self.max_bytes:
+            if to_disk:
+                self._write_disk(key, b)
+            return
+        evicted = []
+        with self._lock:
+            if key in self._blocks:
+                self._size -= len(self._blocks.pop(key))
+            self._blocks[key] = b
+            self._size += len(b)
+            while self._size > self.max_bytes:
+                old_key, old_b = self._blocks.popitem(last=False)
+                self._size -= len(old_b)
+                self.evictions += 1
+                evicted.append((old_key, old_b))
+        # blocks leaving RAM are demoted to the disk tier
+        for old_key, old_b in evicted:
+            self._write_disk(old_key, old_b)
+        if to_disk:
+            self._write_disk(key, b)
+
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._size = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'disk_evictions': self.disk_evictions,
+                    'blocks': len(self._blocks), 'bytes': self._size,
+                    'disk_blocks': len(self._disk_blocks), 'disk_bytes': self._disk_size}
+
+
+    # disk tier helpers, file names are hashes of the cache key
+    def _disk_path(self, key):
+        return self._dir / f'{_hash(repr(key))}.blk'
+
+
+    def _read_disk(self, key):
+        if self._dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                b = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if path.stem in self._disk_blocks:
+                self._disk_blocks.move_to_end(path.stem)
+        return b
+
+
+    def _write_disk(self, key, b):
+        if self._dir is None or len(b) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        with self._lock:
+            if path.stem in self._disk_blocks:
+                self._disk_blocks.move_to_end(path.stem)
+                return
+        # write to a temp file first so a concurrent reader never sees a partial block
+        tmp = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(b)
+        os.replace(tmp, path)
+        stale = []
+        with self._lock:
+            self._disk_blocks[path.stem] = len(b)
+            self._disk_size += len(b)
+            while self._disk_size > self.disk_max_bytes:
+                old_stem, old_size = self._disk_blocks.popitem(last=False)
+                self._disk_size -= old_size
+                self.disk_evictions += 1
+                stale.append(old_stem)
+        for old_stem in stale:
+            try:
+                os.remove(self._dir / f'{old_stem}.blk')
+            except FileNotFoundError:
+                pass
+
+
+# merge overlapping or adjacent [start, end) ranges
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+# split sorted ints into runs of consecutive values
+def _consecutive_runs(values):
+    runs = []
+    for v in values:
+        if runs and v == runs[-1][-1] + 1:
+            runs[-1].append(v)
+        else:
+            runs.append([v])
+    return runs
+
+
+# --- process-wide cache instance --- #
+BLOCK_CACHE = BlockCache()
+
+
+
+#######################################################################################################################
+################################################# PostingCache Class ##################################################
+
+
+# count-min sketch of how often keys are looked up, counters are halved every 10 * width lookups so old
+# popularity fades. the cells of a key are hashed apart from the counter updates, so callers can hash outside their
+# lock and only update plain byte counters under it
+class FrequencySketch:
+    def __init__(self, width=POSTING_SKETCH_WIDTH, depth=4):
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.mask = width - 1
+        self.additions = 0
+        self.sample_size = 10 * width
+
+
+    # column of the key in each row. keys are hashed with blake2b of their repr instead of hash(), which is salted per
+    # process, so every worker maps a key to the same cells
+    def cells(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf8'), digest_size=4 * len(self.rows)).digest()
+        return [int.from_bytes(digest[4 * row:4 * row + 4], 'little') & self.mask for row in range(len(self.rows))]
+
+
+    def increment(self, cells):
+        for row, col in zip(self.rows, cells):
+            if row[col] < 255:
+                row[col] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                counters = np.frombuffer(row, dtype=np.uint8)
+                counters >>= 1
+            self.additions //= 2
+
+
+    def estimate(self, cells):
+        return min(row[col] for row, col in zip(self.rows, cells))
+
+
+# byte-budgeted LRU of decoded (doc_ids, tfs) posting arrays, shared by all indexes of the process.
+# admission is TinyLFU-like and size-aware: a posting list only gets in when it was looked up more often than all the
+# lists it would evict together, so one long list of a frequent term can't flush many small useful ones.
+# pinned lists are kept outside the budget and never evicted
+class PostingCache:
+    def __init__(self, max_bytes=POSTING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (doc_ids, tfs), least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._pinned = {}
+        self.sketch = FrequencySketch()
+        # counters used to size the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+
+    @staticmethod
+    def _nbytes(postings):
+        return postings[0].nbytes + postings[1].nbytes
+
+
+    def get(self, key):
+        cells = self.sketch.cells(key)
+        with self._lock:
+            self.sketch.increment(cells)
+            postings = self._pinned.get(key)
+            if postings is None:
+                postings = self._entries.get(key)
+                if postings is not None:
+                    self._entries.move_to_end(key)
+            if postings is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return postings
+
+
+    def put(self, key, postings):
+        size = self._nbytes(postings)
+        if size > self.max_bytes:
+            self.rejections += 1
+            return
+        cells = self.sketch.cells(key)
+        with self._lock:
+            if key in self._entries or key in self._pinned:
+                return
+            # least recently used entries that have to go for the postings to fit
+            victims = []
+            freed = 0
+            for victim in self._entries:
+                if self._size - freed + size <= self.max_bytes:
+                    break
+                victims.append(victim)
+                freed += self._nbytes(self._entries[victim])
+            if victims and self.sketch.estimate(cells) <= sum(self.sketch.estimate(self.sketch.cells(victim)) for victim in victims):
+                self.rejections += 1
+                return
+            for victim in victims:
+                self._size -= self._nbytes(self._entries.pop(victim))
+                self.evictions += 1
+            self._entries[key] = postings
+            self._size += size
+
+
+    def pin(self, key, postings):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._nbytes(self._entries.pop(key))
+            self._pinned[key] = postings
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'rejections': self.rejections,
+                    'entries': len(self._entries), 'bytes': self._size,
+                    'pinned': len(self._pinned), 'pinned_bytes': sum(map(self._nbytes, self._pinned.values()))}
+
+
+# --- process-wide cache instance --- #
+POSTING_CACHE = PostingCache()
+
+
+
+#######################################################################################################################
+############################################### Storage Backend Classes ###############################################
+
+
+# GCP bucket, paths are blob names
+class GCSBackend:
+    zero_copy = False
+
+    def __init__(self, bucket_name):
+        # imported here so nodes serving from local disk don't need the GCP client
+        from google.cloud import storage
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+
+    # bytes of a blob, or of its [start, end) range
+    def read(self, path, start=None, end=None):
+        blob = self.bucket.blob(path)
+        if start is None:
+            return blob.download_as_string()
+        # GCS ranges are inclusive
+        return blob.download_as_bytes(start=start, end=end - 1)
+
+
+    def upload(self, local_path, path):
+        self.bucket.blob(path).upload_from_filename(str(local_path))
+
+
+    # path of a local copy of the blob, downloaded to local_path. the download is appended to a .part file (named by
+    # the blob generation) in chunks, so a download that was interrupted resumes where it stopped
+    def local_path(self, path, local_path):
+        local_path = Path(local_path)
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        part = local_path.with_name(f'{local_path.name}.{blob.generation}.part')
+        start = part.stat().st_size if part.exists() else 0
+        with open(part, 'ab') as f:
+            while start < blob.size:
+                end = min(start + DOWNLOAD_CHUNK_SIZE, blob.size)
+                f.write(blob.download_as_bytes(start=start, end=end - 1, if_generation_match=blob.generation))
+                start = end
+        os.replace(part, local_path)
+        return local_path
+
+
+# plain directory laid out like the bucket
+class LocalBackend:
+    zero_copy = False
+
+    def __init__(self, base_dir):
+        self.base_dir = Path(base_dir)
+
+
+    def read(self, path, start=None, end=None):
+        with open(self.base_dir / path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(end - start)
+
+
+    def upload(self, local_path, path):
+        dst = self.base_dir / path
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if Path(local_path).resolve() != dst.resolve():
+            shutil.copyfile(local_path, dst)
+
+
+    # files are already local, so no copy is made
+    def local_path(self, path, local_path):
+        return self.base_dir / path
+
+
+# directory laid out like the bucket, files are memory-mapped and served as zero-copy memoryviews
+class MmapBackend(LocalBackend):
+    zero_copy = True
+
+    def __init__(self, base_dir):
+        super().__init__(base_dir)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+
+    def read(self, path, start=None, end=None):
+        view = self._view(path)
+        if start is None:
+            return view
+        return view[start:end]
+
+
+    def _view(self, path):
+        with self._lock:
+            if path not in self._maps:
+                with open(self.base_dir / path, 'rb') as f:
+                    self._maps[path] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return self._maps[path]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+
+
+# shared backend for a bucket, selected by IR_STORAGE_BACKEND. its client is reused by every reader and writer
+def get_backend(bucket_name, kind=None, base_dir=None):
+    kind = kind or STORAGE_BACKEND
+    base_dir = base_dir or INDEX_DIR
+    key = (kind, bucket_name, base_dir)
+    with _backends_lock:
+        if key not in _backends:
+            if kind == 'gcs':
+                _backends[key] = GCSBackend(bucket_name)
+            elif kind in ('local', 'mmap'):
+                if not base_dir:
+                    raise ValueError(f"storage backend '{kind}' needs IR_INDEX_DIR")
+                _backends[key] = LocalBackend(base_dir) if kind == 'local' else MmapBackend(base_dir)
+            else:
+                raise ValueError(f"unknown storage backend '{kind}'")
+        return _backends[key]
+
+
+# shared thread pool for background uploads, created on first use
+def get_upload_pool():
+    global _upload_pool
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+        return _upload_pool
+
+
+# upload a local file, retrying failed attempts with exponential backoff
+def upload_with_retries(backend, local_path, path, retries=UPLOAD_RETRIES):
+    for attempt in range(retries):
+        try:
+            return backend.upload(local_path, path)
+        except Exception:
+            if attempt == retries - 1:
+                raise
+            time.sleep(UPLOAD_BACKOFF * 2 ** attempt)
+
+
+
 ######################################################################################################################
 ################################################ MultiFileWriter Class ################################################
 
 
-#writer to GCP
+#writer to GCP (or to the configured storage backend). full files are uploaded in the background while the next ones
+#are written, and upload_to_gcp() / close() wait until all of them are uploaded. the files are opened by absolute path,
+#so uploads in flight still find them if the working directory changes
 class MultiFileWriter:
-    def __init__(self, base_dir, name, bucket_name, ii_name):
-        self._base_dir = Path(base_dir)
+    def __init__(self, base_dir, name, bucket_name, ii_name, backend=None):
+        self._base_dir = Path(base_dir).resolve()
         self._name = name
         self._file_gen = (open(self._base_dir / f'{name}_{i:03}.bin', 'wb') for i in itertools.count())
         self._f = next(self._file_gen)
-        self.client = storage.Client()
-        self.bucket = self.client.bucket(bucket_name)
+        self.backend = get_backend(bucket_name) if backend is None else backend
         self.ii_name = ii_name
+        # uploads in flight, oldest first
+        self._uploads = []
         
         
     # write to file
@@ -64,12 +568,12 @@ class MultiFileWriter:
             remaining = BLOCK_SIZE - pos
             if remaining == 0:  
                 self._f.close()
-                self.upload_to_gcp()                
+                self._upload_async()
                 self._f = next(self._file_gen)
                 pos, remaining = 0, BLOCK_SIZE
             
             self._f.write(b[:remaining])
-            locs.append((self._f.name, pos))
+            locs.append((Path(self._f.name).name, pos))
             b = b[remaining:]
         
         return locs
@@ -77,14 +581,48 @@ class MultiFileWriter:
 
     def close(self):
         self._f.close()
+        self._join()
+
+
+    def __enter__(self):
+        return self
+
+
+    # used as a context manager, an error raised while writing is the one that propagates: the uploads in flight are
+    # still waited for, but their errors are dropped
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return False
+        try:
+            self._f.close()
+        finally:
+            self._join(raise_errors=False)
+        return False
     
     
-    # upload file to GCP
+    # upload the current file to GCP, and wait for the uploads still in flight
     def upload_to_gcp(self):
         self._f.close()
+        self._upload_async()
+        self._join()
+
+
+    # hand the current (closed) file to the upload pool, waiting for the oldest upload when UPLOAD_QUEUE are in flight
+    def _upload_async(self):
+        if len(self._uploads) >= UPLOAD_QUEUE:
+            self._uploads.pop(0).result()
         file_name = self._f.name
-        blob = self.bucket.blob(f"{self.ii_name}/{file_name}")
-        blob.upload_from_filename(file_name)
+        self._uploads.append(get_upload_pool().submit(upload_with_retries, self.backend, file_name,
+                                                      f"{self.ii_name}/{Path(file_name).name}"))
+
+
+    # wait for all uploads in flight, the first failed upload (after its retries) is raised once all are done
+    def _join(self, raise_errors=True):
+        uploads, self._uploads = self._uploads, []
+        errors = [error for error in (upload.exception() for upload in uploads) if error is not None]
+        if errors and raise_errors:
+            raise errors[0]
 
 
 
@@ -92,34 +630,126 @@ class MultiFileWriter:
 ################################################ MultiFileReader Class ################################################
 
         
-#reader from GCP
+#reader from GCP (or from the configured storage backend), posting files are served from the shared BLOCK_CACHE
 class MultiFileReader:
-    def __init__(self, ii_name, bucket_name):
-        self._open_files = {}
+    def __init__(self, ii_name, bucket_name, cache=None, range_reads=RANGE_READS, backend=None):
         self.ii_name = ii_name
-        self.client = storage.Client()
-        self.bucket = self.client.bucket(bucket_name)
+        self.bucket_name = bucket_name
+        self.cache = BLOCK_CACHE if cache is None else cache
+        self.range_reads = range_reads
+        self.backend = get_backend(bucket_name) if backend is None else backend
+        # transfer counters
+        self.requests = 0
+        self.bytes_read = 0
 
 
     # read file from GCP
     def read(self, locs, n_bytes):
-        b = []
+        return self.read_segments([list(self._segments(locs, n_bytes))])[0]
+
+
+    # read several posting lists of one query, ranges that touch the same file are merged into one request
+    def read_many(self, requests):
+        return self.read_segments([list(self._segments(locs, n_bytes)) for locs, n_bytes in requests])
+
+
+    # read only the [start, end) byte ranges of a posting list of n_bytes
+    def read_ranges(self, locs, n_bytes, ranges):
+        return self.read_segments([[seg for start, end in ranges for seg in self._segments(locs, n_bytes, start, end)]])[0]
+
+
+    # bytes of each list of (file_name, start, end) segments
+    def read_segments(self, requests):
+        if self.backend.zero_copy:
+            return [self._read_mapped(segs) for segs in requests]
+        if not self.range_reads:
+            return [b''.join(self._get_block(f_name)[start:end] for f_name, start, end in segs) for segs in requests]
+        
+        spans = defaultdict(list)
+        for segs in requests:
+            for f_name, start, end in segs:
+                spans[f_name].append((start, end))
+        
+        pages = {}
+        for f_name, file_spans in spans.items():
+            for start, end in _merge_ranges(file_spans):
+                pages.update(self._get_pages(f_name, start, end))
+        
+        return [b''.join(self._slice_pages(pages, f_name, start, end) for f_name, start, end in segs) for segs in requests]
+
+
+    # postings of a memory-mapped index are sliced straight out of the page cache, without the block cache
+    def _read_mapped(self, segs):
+        segments = [self.backend.read(f"{self.ii_name}/{f_name}", start, end) for f_name, start, end in segs]
+        if len(segments) == 1:
+            return segments[0]
+        return b''.join(segments)
+
+
+    # (file_name, start, end) byte ranges holding bytes [start, end) of a posting list of n_bytes
+    @staticmethod
+    def _segments(locs, n_bytes, start=0, end=None):
+        end = n_bytes if end is None else min(end, n_bytes)
+        pos = 0
         for f_name, offset in locs:
-            if f_name not in self._open_files:
-                self._open_files[f_name] = io.BytesIO(self.bucket.blob(f"{self.ii_name}/{f_name}").download_as_string())
-            
-            f = self._open_files[f_name]
-            f.seek(offset)
-            n_read = min(n_bytes, BLOCK_SIZE - offset)
-            b.append(f.read(n_read))
-            n_bytes -= n_read
+            if pos >= end:
+                break
+            n_read = min(n_bytes - pos, BLOCK_SIZE - offset)
+            seg_start, seg_end = max(start, pos), min(end, pos + n_read)
+            if seg_start < seg_end:
+                yield f_name, offset + seg_start - pos, offset + seg_end - pos
+            pos += n_read
+
+
+    # fetch the RANGE_PAGE_SIZE pages covering [start, end), missing pages are fetched as contiguous runs
+    def _get_pages(self, f_name, start, end):
+        pages = {}
+        missing = []
+        for p in range(start // RANGE_PAGE_SIZE, (end - 1) // RANGE_PAGE_SIZE + 1):
+            key = (self.bucket_name, self.ii_name, f_name, p)
+            page = self.cache.get(key)
+            if page is None:
+                missing.append(p)
+            else:
+                pages[(f_name, p)] = page
         
-        return b''.join(b)
+        for run in _consecutive_runs(missing):
+            run_start = run[0] * RANGE_PAGE_SIZE
+            b = self._fetch(f_name, run_start, min((run[-1] + 1) * RANGE_PAGE_SIZE, BLOCK_SIZE))
+            for p in run:
+                page = b[(p - run[0]) * RANGE_PAGE_SIZE:(p - run[0] + 1) * RANGE_PAGE_SIZE]
+                self.cache.put((self.bucket_name, self.ii_name, f_name, p), page)
+                pages[(f_name, p)] = page
+        
+        return pages
+
+
+    @staticmethod
+    def _slice_pages(pages, f_name, start, end):
+        out = []
+        for p in range(start // RANGE_PAGE_SIZE, (end - 1) // RANGE_PAGE_SIZE + 1):
+            page_start = p * RANGE_PAGE_SIZE
+            out.append(pages[(f_name, p)][max(start - page_start, 0):end - page_start])
+        return b''.join(out)
+
+
+    # whole posting file, from the cache or downloaded on a miss
+    def _get_block(self, f_name):
+        key = (self.bucket_name, self.ii_name, f_name)
+        return self.cache.get_or_load(key, lambda: self._fetch(f_name))
+
+
+    # download [start, end) of a posting file, or all of it
+    def _fetch(self, f_name, start=None, end=None):
+        b = self.backend.read(f"{self.ii_name}/{f_name}", start, end)
+        self.requests += 1
+        self.bytes_read += len(b)
+        return b
   
   
+    # blocks belong to the shared cache, so there is nothing to release here
     def close(self):
-        for f in self._open_files.values():
-            f.close()
+        pass
 
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -127,6 +757,19 @@ class MultiFileReader:
         return False 
 
 
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+# shared reader per (index, bucket), it lives for the whole process
+def get_reader(ii_name, bucket_name):
+    key = (ii_name, bucket_name)
+    with _readers_lock:
+        if key not in _readers:
+            _readers[key] = MultiFileReader(ii_name, bucket_name)
+        return _readers[key]
+
+
 
 #######################################################################################################################
 ############################################### InvertedIndex Class ###################################################
@@ -145,6 +788,17 @@ class InvertedIndex:
         self._posting_list = defaultdict(list)
         # mapping a term to posting file locations, which is a list of (file_name, offset) pairs. 
         self.posting_locs = defaultdict(list)
+        # on-disk format of the postings, see posting_codec
+        self.posting_format = posting_codec.FORMAT_FIXED
+        # stores encoded size in bytes per term, only needed by variable-size formats
+        self.posting_nbytes = Counter()
+        # stores the max normalized tf (tf / DL) per term, and per block of BLOCK_POSTINGS postings for longer lists
+        # (only in the fixed posting format, the only one whose blocks can be read on their own)
+        self.term_max = {}
+        self.block_max = {}
+        # impact-ordered indexes: (impact, count) segments per term, highest impact first, and the score of impact IMPACT_LEVELS
+        self.impact_segments = {}
+        self.impact_scale = 0.0
 
 
     # write index variables (not pistings) to GCP
@@ -164,25 +818,69 @@ class InvertedIndex:
         return state
 
 
-    # read index from gcp
+    # indexes pickled before a variable was added get its default
+    def __setstate__(self, state):
+        self.__dict__.update(InvertedIndex().__dict__)
+        self.__dict__.update(state)
+
+
+    # number of bytes holding the posting list of w
+    def _posting_size(self, w):
+        if self.posting_format == posting_codec.FORMAT_FIXED:
+            return self.df[w] * TUPLE_SIZE
+        if self.posting_format == posting_codec.FORMAT_IMPACT:
+            return self.df[w] * posting_codec.DOC_ID_SIZE
+        return self.posting_nbytes[w]
+
+
+    # (bytes, posting file names) read for the posting list of w, or only for its given blocks (see read_posting_blocks)
+    def posting_extent(self, w, blocks=None):
+        if w not in self.df.keys():
+            return 0, []
+        ranges = [(0, self._posting_size(w))]
+        if blocks is not None:
+            block_bytes = BLOCK_POSTINGS * TUPLE_SIZE
+            ranges = _merge_ranges([(block * block_bytes, (block + 1) * block_bytes) for block in blocks])
+        segs = [seg for start, end in ranges for seg in MultiFileReader._segments(self.posting_locs[w], self._posting_size(w), start, end)]
+        return sum(end - start for f_name, start, end in segs), sorted({f_name for f_name, start, end in segs})
+
+
     @staticmethod
     def read_index(base_dir, name, bucket_name):
-        i_src = f'gs://{bucket_name}/{base_dir}/{name}.pkl'
-        gscom = "gsutil cp " + i_src + " ."
-        os.system(gscom)
-        with open(f'{name}.pkl', 'rb') as f:
+        path = get_backend(bucket_name).local_path(f'{base_dir}/{name}.pkl', f'{name}.pkl')
+        with open(path, 'rb') as f:
             return pickle.load(f)
 
 
-    # write posting list to GCP
+    # read index variables from a lexicon directory (see lexicon.py) instead of the pickle
     @staticmethod
-    def write_a_posting_list(b_w_pl, bucket_name, ii_name):
+    def read_lexicon(path):
+        # imported here so the index builder can ship this module without lexicon.py
+        from lexicon import Lexicon
+        index = InvertedIndex()
+        index.__dict__.update(Lexicon.open(path).index_variables())
+        return index
+
+
+    # write index variables as a lexicon directory
+    def write_lexicon(self, path):
+        from lexicon import Lexicon
+        Lexicon.write(self, path)
+
+
+    # write posting list to GCP, returns the bucket id and the encoded size of each posting list written in a
+    # variable-size format (the index's posting_nbytes, empty for fixed-size postings)
+    @staticmethod
+    def write_a_posting_list(b_w_pl, bucket_name, ii_name, posting_format=posting_codec.FORMAT_FIXED):
         posting_locs = defaultdict(list)
+        posting_nbytes = {}
         bucket_id, list_w_pl = b_w_pl
-        with closing(MultiFileWriter('.', bucket_id, bucket_name, ii_name)) as writer:
+        with MultiFileWriter('.', bucket_id, bucket_name, ii_name) as writer:
             for w, pl in list_w_pl:
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big') for doc_id, tf in pl])
+                b = posting_codec.encode_posting_list(pl, posting_format)
+                if posting_format != posting_codec.FORMAT_FIXED:
+                    posting_nbytes[w] = len(b)
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
@@ -191,36 +889,153 @@ class InvertedIndex:
             writer.upload_to_gcp() 
             InvertedIndex._upload_posting_locs(bucket_id, posting_locs, bucket_name, ii_name)
         
+        return bucket_id, posting_nbytes
+    
+    
+    # write impact-ordered posting list to GCP, DL is a broadcast of the {doc_id: length} dict
+    @staticmethod
+    def write_impact_posting_list(b_w_pl, bucket_name, ii_name, DL, N, scale):
+        posting_locs = defaultdict(list)
+        bucket_id, list_w_pl = b_w_pl
+        with MultiFileWriter('.', bucket_id, bucket_name, ii_name) as writer:
+            for w, pl in list_w_pl:
+                doc_ids, _ = InvertedIndex.get_impact_postings(pl, DL.value, N, scale)
+                locs = writer.write(posting_codec.encode(doc_ids, None, posting_codec.FORMAT_IMPACT))
+                posting_locs[w].extend(locs)
+            
+            writer.upload_to_gcp() 
+            InvertedIndex._upload_posting_locs(bucket_id, posting_locs, bucket_name, ii_name)
+        
         return bucket_id
     
     
     # upload posting locs to GCP
     @staticmethod
-    def _upload_posting_locs(bucket_id, posting_locs, bucket_name, ii_name):
-        with open(f"{bucket_id}_posting_locs.pickle", "wb") as f:
+    def _upload_posting_locs(bucket_id, posting_locs, bucket_name, ii_name, base_dir='.'):
+        file_name = Path(base_dir) / f"{bucket_id}_posting_locs.pickle"
+        with open(file_name, "wb") as f:
             pickle.dump(posting_locs, f)
        
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob_posting_locs = bucket.blob(f"{ii_name}/{bucket_id}_posting_locs.pickle")
-        blob_posting_locs.upload_from_filename(f"{bucket_id}_posting_locs.pickle")
+        upload_with_retries(get_backend(bucket_name), str(file_name), f"{ii_name}/{bucket_id}_posting_locs.pickle")
 
 
     # read posting list from GCP by given term w
     def read_posting_list(self, w, ii_name, bucket_list):
-        if w in self.df.keys() and self.posting_locs.keys():
-            with closing(MultiFileReader(ii_name, bucket_list)) as reader:
-                locs = self.posting_locs[w]
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                    tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                
-                return posting_list
-        
-        return []
+        doc_ids, tfs = self.read_posting_array(w, ii_name, bucket_list)
+        return list(zip(doc_ids.tolist(), tfs.tolist()))
+
+
+    # read the posting lists of several terms at once, so range reads of one query can share requests
+    def read_posting_lists(self, ws, ii_name, bucket_list):
+        return {w: list(zip(doc_ids.tolist(), tfs.tolist())) for w, (doc_ids, tfs) in self.read_posting_arrays(ws, ii_name, bucket_list).items()}
+
+
+    # read posting list of term w as (doc_ids, tfs) arrays
+    def read_posting_array(self, w, ii_name, bucket_list):
+        return self.read_posting_arrays([w], ii_name, bucket_list).get(w, posting_codec.decode(b''))
+
+
+    # read only the given blocks (of BLOCK_POSTINGS postings) of the posting list of w, as (doc_ids, tfs) arrays.
+    # decoded blocks are kept in POSTING_CACHE, each under its own key, and only the missing ones are read
+    def read_posting_blocks(self, w, blocks, ii_name, bucket_list):
+        if self.posting_format != posting_codec.FORMAT_FIXED:
+            raise ValueError('only fixed-size postings can be read by block')
+        if w not in self.df.keys() or len(blocks) == 0:
+            return posting_codec.decode(b'')
+        
+        blocks = sorted(set(int(block) for block in blocks))
+        postings = {}
+        for block in blocks:
+            cached = POSTING_CACHE.get(self._block_cache_key(w, block, ii_name, bucket_list))
+            if cached is not None:
+                postings[block] = cached
+        
+        missing = [block for block in blocks if block not in postings]
+        count('posting_lists', field=ii_name, cache='blocks' if missing else 'hit')
+        if missing:
+            block_bytes = BLOCK_POSTINGS * TUPLE_SIZE
+            n_bytes = self._posting_size(w)
+            ranges = _merge_ranges([(block * block_bytes, (block + 1) * block_bytes) for block in missing])
+            reader = get_reader(ii_name, bucket_list)
+            with timer(f'read_{ii_name}'):
+                b = reader.read_ranges(self.posting_locs[w], n_bytes, ranges)
+            count('posting_bytes', len(b), field=ii_name)
+            count('posting_files', len({f_name for start, end in ranges
+                                        for f_name, seg_start, seg_end in MultiFileReader._segments(self.posting_locs[w], n_bytes, start, end)}), field=ii_name)
+            with timer(f'decode_{ii_name}'):
+                doc_ids, tfs = posting_codec.decode(b)
+                # the last block of the list may be partial
+                sizes = [min(BLOCK_POSTINGS, self.df[w] - block * BLOCK_POSTINGS) for block in missing]
+                splits = np.cumsum(sizes)[:-1]
+                for block, block_doc_ids, block_tfs in zip(missing, np.split(doc_ids, splits), np.split(tfs, splits)):
+                    block_doc_ids.flags.writeable = False
+                    block_tfs.flags.writeable = False
+                    postings[block] = (block_doc_ids, block_tfs)
+                    POSTING_CACHE.put(self._block_cache_key(w, block, ii_name, bucket_list), postings[block])
+        
+        if len(blocks) == 1:
+            return postings[blocks[0]]
+        return (np.concatenate([postings[block][0] for block in blocks]), np.concatenate([postings[block][1] for block in blocks]))
+
+
+    # doc_ids of postings [start, end) of w in an impact-ordered index
+    def read_impact_postings(self, w, start, end, ii_name, bucket_list):
+        if w not in self.df.keys() or start >= end:
+            return np.zeros(0, dtype=np.int64)
+        
+        reader = get_reader(ii_name, bucket_list)
+        ranges = [(start * posting_codec.DOC_ID_SIZE, end * posting_codec.DOC_ID_SIZE)]
+        return posting_codec.decode_doc_ids(reader.read_ranges(self.posting_locs[w], self._posting_size(w), ranges))
+
+
+    # read the posting lists of several terms as {w: (doc_ids, tfs)}. decoded lists are kept in POSTING_CACHE, they are
+    # shared and read-only
+    def read_posting_arrays(self, ws, ii_name, bucket_list):
+        ws = [w for w in dict.fromkeys(ws) if w in self.df.keys() and self.posting_locs.keys()]
+        postings = {}
+        for w in ws:
+            cached = POSTING_CACHE.get(self._cache_key(w, ii_name, bucket_list))
+            if cached is not None:
+                postings[w] = cached
+        
+        missing = [w for w in ws if w not in postings]
+        if postings:
+            count('posting_lists', len(postings), field=ii_name, cache='hit')
+        if missing:
+            count('posting_lists', len(missing), field=ii_name, cache='miss')
+            reader = get_reader(ii_name, bucket_list)
+            with timer(f'read_{ii_name}'):
+                bs = reader.read_many([(self.posting_locs[w], self._posting_size(w)) for w in missing])
+            count('posting_bytes', sum(map(len, bs)), field=ii_name)
+            count('posting_files', len({f_name for w in missing for f_name, offset in self.posting_locs[w]}), field=ii_name)
+            with timer(f'decode_{ii_name}'):
+                for w, b in zip(missing, bs):
+                    postings[w] = self._decode_shared(b, w)
+                    POSTING_CACHE.put(self._cache_key(w, ii_name, bucket_list), postings[w])
+        
+        return {w: postings[w] for w in ws}
+
+
+    # keep the decoded posting lists of ws in POSTING_CACHE for good
+    def pin_posting_lists(self, ws, ii_name, bucket_list):
+        for w, postings in self.read_posting_arrays(ws, ii_name, bucket_list).items():
+            POSTING_CACHE.pin(self._cache_key(w, ii_name, bucket_list), postings)
+
+
+    # df is part of the key, so lists of a rebuilt index are not mixed up with the old ones
+    def _cache_key(self, w, ii_name, bucket_list):
+        return (bucket_list, ii_name, w, self.df[w])
+
+
+    def _block_cache_key(self, w, block, ii_name, bucket_list):
+        return self._cache_key(w, ii_name, bucket_list) + (block,)
+
+
+    def _decode_shared(self, b, w):
+        postings = posting_codec.decode(b, self.df[w], self.posting_format)
+        for array in postings:
+            array.flags.writeable = False
+        return postings
     
 
     # functions to calcualte index variables for RDD
@@ -234,9 +1049,60 @@ class InvertedIndex:
       return postings.mapValues(len)
 
 
+    # max normalized tf (tf / DL) of a posting list, and of each of its blocks when it has more than one block
+    @staticmethod
+    def get_score_bounds(pl, DL):
+      pl = np.asarray(list(pl), dtype=np.int64).reshape(-1, 2)
+      doc_lengths = np.array([DL.get(doc_id, 0) for doc_id in pl[:, 0].tolist()], dtype=np.float64)
+      return InvertedIndex.get_tf_bounds(pl[:, 1], doc_lengths)
+
+
+    # get_score_bounds from the tfs of a posting list and the lengths of its documents (0 for unknown documents)
+    @staticmethod
+    def get_tf_bounds(tfs, doc_lengths):
+      normalized_tf = np.divide(tfs, doc_lengths, out=np.zeros(len(tfs)), where=doc_lengths > 0)
+      if len(tfs) <= BLOCK_POSTINGS:
+        return float(normalized_tf.max(initial=0)), None
+      padded = np.zeros(-(-len(tfs) // BLOCK_POSTINGS) * BLOCK_POSTINGS)
+      padded[:len(tfs)] = normalized_tf
+      return float(normalized_tf.max()), padded.reshape(-1, BLOCK_POSTINGS).max(axis=1)
+
+
+    # (term_max, block_max) per term, DL is a broadcast of the {doc_id: length} dict
+    @staticmethod
+    def calculate_score_bounds(postings, DL):
+      return postings.mapValues(lambda pl: InvertedIndex.get_score_bounds(pl, DL.value))
+
+
+    # postings ordered by quantized normalized tf-idf (highest first, then by doc_id), and their (impact, count) segments.
+    # postings of documents missing from DL are dropped
+    @staticmethod
+    def get_impact_postings(pl, DL, N, scale):
+      pl = np.asarray(list(pl), dtype=np.int64).reshape(-1, 2)
+      doc_lengths = np.array([DL.get(doc_id, 0) for doc_id in pl[:, 0].tolist()], dtype=np.float64)
+      known = doc_lengths > 0
+      doc_ids = pl[known, 0]
+      scores = pl[known, 1] / doc_lengths[known] * np.log10(N / len(pl))
+      impacts = np.clip(np.ceil(scores / scale * IMPACT_LEVELS), 1, IMPACT_LEVELS).astype(np.int64)
+      order = np.lexsort((doc_ids, -impacts))
+      levels, counts = np.unique(impacts, return_counts=True)
+      return doc_ids[order], np.stack([levels[::-1], counts[::-1]], axis=1)
+
+
+    # impact segments per term, see get_impact_postings
+    @staticmethod
+    def calculate_impact_segments(postings, DL, N, scale):
+      return postings.mapValues(lambda pl: InvertedIndex.get_impact_postings(pl, DL.value, N, scale)[1])
+
+
+    @staticmethod
+    def partition_impact_postings_and_write(postings, bucket_name, ii_name, DL, N, scale):
+      return postings.map(lambda x: (token2bucket_id(x[0]), x)).groupByKey().map(lambda x: InvertedIndex.write_impact_posting_list((x[0],x[1]), bucket_name, ii_name, DL, N, scale))
+
+
     @staticmethod
-    def partition_postings_and_write(postings, bucket_name, ii_name):
-      return postings.map(lambda x: (token2bucket_id(x[0]), x)).groupByKey().map(lambda x: InvertedIndex.write_a_posting_list((x[0],x[1]), bucket_name, ii_name))
+    def partition_postings_and_write(postings, bucket_name, ii_name, posting_format=posting_codec.FORMAT_FIXED):
+      return postings.map(lambda x: (token2bucket_id(x[0]), x)).groupByKey().map(lambda x: InvertedIndex.write_a_posting_list((x[0],x[1]), bucket_name, ii_name, posting_format))
 
 
     @staticmethod
@@ -0,0 +1,115 @@
+#imports
+import numpy as np
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Posting layout --- #
+# each posting is (doc_id << 16 | tf) in 6 big-endian bytes: 4 bytes of doc_id followed by 2 bytes of tf
+TUPLE_SIZE = 6
+TF_MASK = 2 ** 16 - 1
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+# --- Posting formats --- #
+# FORMAT_FIXED: TUPLE_SIZE bytes per posting, as above
+# FORMAT_VARBYTE: variable-byte d-gaps of the sorted doc_ids, followed by variable-byte tfs
+# FORMAT_IMPACT: 4 big-endian bytes of doc_id per posting, ordered by impact (see InvertedIndex.impact_segments)
+FORMAT_FIXED = 1
+FORMAT_VARBYTE = 2
+FORMAT_IMPACT = 3
+DOC_ID_SIZE = 4
+
+
+
+#######################################################################################################################
+################################################ Codec Functions ######################################################
+
+
+# decode a posting buffer (bytes, memoryview, ...) into doc_ids and tfs arrays
+def decode(b, df=None, posting_format=FORMAT_FIXED):
+    if posting_format == FORMAT_VARBYTE:
+        return decode_compressed(b, df)
+    if posting_format == FORMAT_IMPACT:
+        doc_ids = decode_doc_ids(b, df)
+        return doc_ids, np.ones(len(doc_ids), dtype=np.int64)
+    postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=-1 if df is None else df)
+    return postings['doc_id'].astype(np.int64), postings['tf'].astype(np.int64)
+
+
+# encode doc_ids and tfs arrays into a posting buffer
+def encode(doc_ids, tfs, posting_format=FORMAT_FIXED):
+    if posting_format == FORMAT_VARBYTE:
+        return encode_compressed(doc_ids, tfs)
+    if posting_format == FORMAT_IMPACT:
+        return encode_doc_ids(doc_ids)
+    doc_ids = np.asarray(doc_ids)
+    postings = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+    postings['doc_id'] = doc_ids
+    postings['tf'] = np.asarray(tfs) & TF_MASK
+    return postings.tobytes()
+
+
+# encode a posting list of (doc_id, tf) pairs
+def encode_posting_list(pl, posting_format=FORMAT_FIXED):
+    if len(pl) == 0:
+        return b''
+    pl = np.asarray(pl, dtype=np.int64).reshape(-1, 2)
+    return encode(pl[:, 0], pl[:, 1], posting_format)
+
+
+# --- impact-ordered format --- #
+def encode_doc_ids(doc_ids):
+    return np.asarray(doc_ids).astype('>u4').tobytes()
+
+
+def decode_doc_ids(b, count=None):
+    return np.frombuffer(b, dtype='>u4', count=-1 if count is None else count).astype(np.int64)
+
+
+# --- compressed format --- #
+def encode_compressed(doc_ids, tfs):
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    gaps = np.diff(doc_ids, prepend=0)
+    return encode_varbyte(gaps) + encode_varbyte(tfs)
+
+
+def decode_compressed(b, df=None):
+    values = decode_varbyte(b, None if df is None else 2 * df)
+    df = len(values) // 2
+    return np.cumsum(values[:df]), values[df:2 * df]
+
+
+# variable-byte encoding: 7 bits per byte, least significant group first, high bit set on all but the last byte
+def encode_varbyte(values):
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    n_groups = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_groups += rest > 0
+        rest >>= np.uint64(7)
+    
+    positions = np.arange(n_groups.max())
+    groups = ((values[:, None] >> (np.uint64(7) * positions.astype(np.uint64))) & np.uint64(0x7f)).astype(np.uint8)
+    groups[positions < n_groups[:, None] - 1] |= 0x80
+    return groups[positions < n_groups[:, None]].tobytes()
+
+
+# decode the first count variable-byte values of b
+def decode_varbyte(b, count=None):
+    groups = np.frombuffer(b, dtype=np.uint8)
+    ends = np.flatnonzero(groups < 0x80)
+    if count is not None:
+        ends = ends[:count]
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    groups = groups[:ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(groups)) - np.repeat(starts, ends - starts + 1)
+    values = (groups & 0x7f).astype(np.uint64) << (np.uint64(7) * positions.astype(np.uint64))
+    return np.add.reduceat(values, starts).astype(np.int64)
@@ -0,0 +1,117 @@
+#imports
+from collections import Counter
+from functools import lru_cache
+import re
+import threading
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Tokenizer --- #
+# words of 3 to 26 characters. the group is non-capturing, so findall returns whole words (the same matches as the
+# [\#\@\w](['\-]?\w){2,24} pattern the indexes were built with)
+RE_WORD = re.compile(r"""[\#\@\w](?:['\-]?\w){2,24}""", re.UNICODE)
+
+# --- Stopwords --- #
+# removed on top of the nltk english stopwords
+corpus_stopwords = ["category", "references", "also", "external", "links",
+                    "may", "first", "see", "history", "people", "one", "two",
+                    "part", "thumb", "including", "second", "following",
+                    "many", "however", "would", "became"]
+
+# --- Stemming --- #
+# distinct words whose stems are memoized, the vocabulary of queries and titles is heavily skewed
+STEM_CACHE_SIZE = 2 ** 18
+
+_analyzer = None
+_analyzer_lock = threading.Lock()
+
+
+
+#######################################################################################################################
+################################################## Analyzer Class #####################################################
+
+
+# the tokenizer, stopwords and stemmer shared by the query path (frontends, backend) and the index builders
+# (IndexBuilder.ipynb, build_index.py), so terms are produced the same way at query and index time
+class Analyzer:
+    def __init__(self, stopwords=None, stem_cache_size=STEM_CACHE_SIZE):
+        # imported here, so modules needing only words() don't need nltk
+        from nltk.stem.porter import PorterStemmer
+        if stopwords is None:
+            from nltk.corpus import stopwords as nltk_stopwords
+            stopwords = frozenset(nltk_stopwords.words('english')).union(corpus_stopwords)
+        self.stopwords = frozenset(stopwords)
+        self.stem_cache_size = stem_cache_size
+        self.stem = lru_cache(maxsize=stem_cache_size)(PorterStemmer().stem)
+
+
+    # pickled without the stem cache (Spark ships the analyzer to its workers with the functions using it), so
+    # workers don't need the nltk stopwords
+    def __getstate__(self):
+        return {'stopwords': self.stopwords, 'stem_cache_size': self.stem_cache_size}
+
+
+    def __setstate__(self, state):
+        self.__init__(state['stopwords'], state['stem_cache_size'])
+
+
+    # all words of a text, lowercased, stopwords included (the body query is scored with them)
+    @staticmethod
+    def words(text):
+        return RE_WORD.findall(text.lower())
+
+
+    # words of a text without stopwords
+    def tokens(self, text):
+        stopwords = self.stopwords
+        return [token for token in RE_WORD.findall(text.lower()) if token not in stopwords]
+
+
+    def stems(self, tokens):
+        return list(map(self.stem, tokens))
+
+
+    # (tokens, stems, counts) of a text: its words without stopwords, their stems (None unless stem), and the counts of
+    # the indexed terms (the stems when stem is set, the tokens otherwise)
+    def analyze(self, text, stem=False):
+        tokens = self.tokens(text)
+        stems = self.stems(tokens) if stem else None
+        return tokens, stems, Counter(stems if stem else tokens)
+
+
+    # analyze a batch of texts in one pass
+    def analyze_batch(self, texts, stem=False):
+        stopwords = self.stopwords
+        findall = RE_WORD.findall
+        stem_token = self.stem
+        analyzed = []
+        for text in texts:
+            tokens = [token for token in findall(text.lower()) if token not in stopwords]
+            stems = list(map(stem_token, tokens)) if stem else None
+            analyzed.append((tokens, stems, Counter(stems if stem else tokens)))
+        return analyzed
+
+
+    def stem_cache_info(self):
+        return self.stem.cache_info()
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# process-wide analyzer, created on first use (after the nltk stopwords are downloaded)
+def get_analyzer():
+    global _analyzer
+    with _analyzer_lock:
+        if _analyzer is None:
+            _analyzer = Analyzer()
+        return _analyzer
+
+
+words = Analyzer.words
@@ -1,17 +1,21 @@
-from numpy import dot
-from numpy.linalg import norm
 import numpy as np
 from collections import Counter
-import pandas as pd
 import math
-import re
-from inverted_index import InvertedIndex
-
-RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
+from inverted_index import InvertedIndex, IMPACT_LEVELS
+import posting_codec
+from doc_stats import DocLengths
+from metrics import timer
+from analyzer import words
 
 # --- Bucket name --- #
 BUCKET_NAME = "ir_project__bucket1"
 
+# --- postings with a normalized tf-idf at or below this value are not candidates --- #
+TFIDF_CUTOFF = 0.1
+
+# --- impact-ordered postings are fetched in chunks of at least this many postings --- #
+IMPACT_FETCH_POSTINGS = 4096
+
 
 
 def generate_tfidf_vector(query, index: InvertedIndex):
@@ -32,62 +36,183 @@ def generate_tfidf_vector(query, index: InvertedIndex):
     return query_vector
 
 
-def get_candidate_documents(query, index: InvertedIndex, words):
-    candidates = {}
-    N = len(index.DL)        
-    for term in np.unique(query):  
-        if term in words:            
-            list_of_doc = index.read_posting_list(term, 'body', BUCKET_NAME)
-            normlized_tfidf= []
-            
-            for doc_id, freq in list_of_doc:
-                if doc_id in index.DL.keys():
-                    normlized_tfidf.append((doc_id,(freq/index.DL[doc_id])*math.log(N/index.df[term],10)))    
-            
-            for doc_id, tfidf in normlized_tfidf:
-                if tfidf > 0.1:
-                    candidates[(doc_id,term)] = candidates.get((doc_id,term), 0) + tfidf     
+# document lengths of doc_ids, 0 for documents missing from the index
+def get_doc_lengths(index: InvertedIndex, doc_ids):
+    DL = index.DL
+    if isinstance(DL, DocLengths):
+        return DL.lookup(doc_ids)
+    return np.fromiter((DL.get(doc_id, 0) for doc_id in doc_ids.tolist()), dtype=np.float64, count=len(doc_ids))
+
+
+# terms of the query whose postings are needed, as {term: blocks}, where blocks is None for the whole posting list.
+# the index's term_max / block_max bounds skip terms and blocks whose postings can't pass the cutoff. blocks are only
+# skipped in fixed-size postings (block_max is only stored for them), compressed posting lists are read whole
+def get_needed_postings(query, index: InvertedIndex, words):
+    needed = {}
+    N = len(index.DL)
+    for term in np.unique(query):
+        if term not in words:
+            continue
+        idf = math.log(N / index.df[term], 10)
+        if term in index.term_max and index.term_max[term] * idf <= TFIDF_CUTOFF:
+            continue
+        block_max = index.block_max.get(term)
+        if block_max is None or index.posting_format != posting_codec.FORMAT_FIXED:
+            needed[term] = None
+            continue
+        blocks = np.flatnonzero(block_max * idf > TFIDF_CUTOFF)
+        needed[term] = None if len(blocks) == len(block_max) else blocks
     
-    return candidates
-
-
-def generate_document_tfidf_matrix(query, index: InvertedIndex, words):
-    candidates_scores = get_candidate_documents(query,index,words)
-    unique_candidates = np.unique([doc_id for doc_id, _ in candidates_scores.keys()])
-    # now matrix is by length of query
-    D = np.zeros((len(unique_candidates), len(query)))
-    D = pd.DataFrame(D)
+    return needed
+
+
+# (doc_ids, tfs) of one needed term's postings, see get_needed_postings
+def read_term_postings(index: InvertedIndex, term, blocks):
+    if blocks is None:
+        return index.read_posting_array(term, 'body', BUCKET_NAME)
+    return index.read_posting_blocks(term, blocks, 'body', BUCKET_NAME)
+
+
+# {term: (doc_ids, tfs)} of the needed postings, whole posting lists are read together so range reads can share requests
+def read_needed_postings(index: InvertedIndex, needed):
+    postings = index.read_posting_arrays([term for term, blocks in needed.items() if blocks is None], 'body', BUCKET_NAME)
+    for term, blocks in needed.items():
+        if blocks is not None:
+            postings[term] = read_term_postings(index, term, blocks)
+    return postings
+
+
+# returns {term: (doc_ids, tfidf)} arrays of the postings whose normalized tf-idf is above TFIDF_CUTOFF.
+# postings are read unless they were already fetched ({term: (doc_ids, tfs)} of the needed postings)
+def get_candidate_documents(query, index: InvertedIndex, words, postings=None):
+    N = len(index.DL)
+    if postings is None:
+        postings = read_needed_postings(index, get_needed_postings(query, index, words))
+    return {term: get_term_candidates(index, term, term_postings, N) for term, term_postings in postings.items()}
+
+
+# (doc_ids, tfidf) of one term's postings above TFIDF_CUTOFF
+def get_term_candidates(index: InvertedIndex, term, postings, N):
+    doc_ids, tfs = postings
+    doc_lengths = get_doc_lengths(index, doc_ids)
+    known = doc_lengths > 0
+    doc_ids = doc_ids[known]
+    normlized_tfidf = (tfs[known] / doc_lengths[known]) * math.log(N / index.df[term], 10)
+    above_cutoff = normlized_tfidf > TFIDF_CUTOFF
+    return doc_ids[above_cutoff], normlized_tfidf[above_cutoff]
+
+
+# term-at-a-time cosine similarity between the query vector and the candidate documents.
+# columns are accumulated in query order, like a dot product over the document vectors, where a repeated
+# query term spans several columns but only its first column has a query weight
+def cosine_similarity(query, query_vector, candidates):
+    if not candidates:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    
+    doc_ids = np.unique(np.concatenate([term_doc_ids for term_doc_ids, _ in candidates.values()]))
+    rows = {term: np.searchsorted(doc_ids, term_doc_ids) for term, (term_doc_ids, _) in candidates.items()}
+    dots = np.zeros(len(doc_ids))
+    squared_norms = np.zeros(len(doc_ids))
+    for position, term in enumerate(query):
+        if term in candidates:
+            tfidf = candidates[term][1]
+            dots[rows[term]] += query_vector[position] * tfidf
+            squared_norms[rows[term]] += tfidf * tfidf
+    
+    return doc_ids, dots / (np.linalg.norm(query_vector) * np.sqrt(squared_norms))
 
-    D.index = unique_candidates
-    D.columns = query
 
-    for key in candidates_scores:
-        tfidf = candidates_scores[key]
-        doc_id, term = key  
-        D.loc[doc_id][term] = tfidf
+# top N doc_ids and their scores, as arrays, ties are broken by ascending doc_id
+def get_top_n(doc_ids, scores, N=10):
+    candidates = np.arange(len(scores))
+    if len(scores) > N:
+        kth_score = np.partition(scores, len(scores) - N)[len(scores) - N]
+        candidates = np.flatnonzero(scores >= kth_score)
     
-    return D
+    top = candidates[np.lexsort((doc_ids[candidates], -scores[candidates]))][:N]
+    return doc_ids[top], scores[top]
 
 
-def cosine_similarity(doc_matrix, query_vector):
-    cos_sims = dict()
-    for doc in doc_matrix.axes[0]:
-      cos_sim = query_vector.dot( doc_matrix.loc[doc]) / (norm(query_vector) * norm(doc_matrix.loc[doc]))
-      cos_sims[doc] = cos_sim
-    
-    return cos_sims
+# body_query is the query, or its already tokenized words (analyzer.words). postings are the already fetched needed
+# postings of the query, if any (see get_needed_postings). returns the top N (doc_ids, scores)
+def get_body_tfidf_score(body_query, body_index: InvertedIndex ,N = 5, postings=None):
+    body_query_tokens = words(body_query) if isinstance(body_query, str) else body_query
+    index_words = body_index.term_total.keys()
+    Q = generate_tfidf_vector(body_query_tokens, body_index)
+    with timer('body_candidates'):
+        candidates = get_candidate_documents(body_query_tokens, body_index, index_words, postings)
+    with timer('body_cosine'):
+        doc_ids, cos_sim = cosine_similarity(body_query_tokens, Q, candidates)
+        topN = get_top_n(doc_ids, cos_sim, N)
+    return topN
+
 
 
-def get_top_n(sim_dict, N=10):
-    docs_and_scores = [(k, v) for k, v in sim_dict.items()]
-    return sorted(docs_and_scores, key = lambda x: x[1],reverse=True)[:N]
+# score-at-a-time evaluation over an impact-ordered body index: segments of all query terms are processed from the
+# highest (query tf * impact) down, and evaluation stops once no remaining segment can change the top N documents.
+# ii_name is the directory the impact-ordered postings were written to. returns the top N (doc_ids, scores)
+def get_body_impact_score(body_query, impact_index: InvertedIndex, N=100, ii_name='impact'):
+    body_query_tokens = words(body_query) if isinstance(body_query, str) else body_query
+    counter = Counter(body_query_tokens)
+    
+    # (contribution, term, start, end) per segment, and the contributions still ahead of each term
+    segments = []
+    pending = {}
+    for term, query_tf in counter.items():
+        if term not in impact_index.impact_segments:
+            continue
+        start = 0
+        pending[term] = []
+        for impact, count in impact_index.impact_segments[term].tolist():
+            segments.append((query_tf * impact, term, start, start + count))
+            pending[term].append(query_tf * impact)
+            start += count
+        pending[term].reverse()
+    segments.sort(key=lambda segment: -segment[0])
+    
+    fetched = {term: np.zeros(0, dtype=np.int64) for term in pending}
+    # scores of the documents seen so far, aligned with their sorted doc ids
+    doc_ids = np.zeros(0, dtype=np.int64)
+    scores = np.zeros(0)
+    for contribution, term, start, end in segments:
+        # fetch the postings of this segment, and of the following ones in the same request
+        if end > len(fetched[term]):
+            fetch_end = min(max(end, len(fetched[term]) + IMPACT_FETCH_POSTINGS), impact_index.df[term])
+            more = impact_index.read_impact_postings(term, len(fetched[term]), fetch_end, ii_name, BUCKET_NAME)
+            fetched[term] = np.concatenate([fetched[term], more])
+        
+        segment_doc_ids = fetched[term][start:end]
+        merged = np.union1d(doc_ids, segment_doc_ids)
+        if len(merged) > len(doc_ids):
+            merged_scores = np.zeros(len(merged))
+            merged_scores[np.searchsorted(merged, doc_ids)] = scores
+            doc_ids, scores = merged, merged_scores
+        np.add.at(scores, np.searchsorted(doc_ids, segment_doc_ids), contribution)
+        pending[term].pop()
+        
+        # the top N is stable when the N-th score beats the (N+1)-th by more than all remaining contributions
+        if len(scores) > N:
+            remaining = sum(term_pending[-1] for term_pending in pending.values() if term_pending)
+            top = np.partition(scores, [len(scores) - N - 1, len(scores) - N])
+            if top[len(scores) - N] > top[len(scores) - N - 1] + remaining:
+                break
+    
+    return get_top_n(doc_ids, scores * (impact_index.impact_scale / IMPACT_LEVELS), N)
 
 
-def get_body_tfidf_score(body_query, body_index: InvertedIndex ,N = 5):
-    body_query_tokens = [token.group() for token in RE_WORD.finditer(body_query.lower())]
-    words = body_index.term_total.keys()
-    Q = generate_tfidf_vector(body_query_tokens, body_index)
-    D = generate_document_tfidf_matrix(body_query_tokens, body_index, words)
-    cos_sim = cosine_similarity(D,Q)
-    topN = get_top_n(cos_sim, N)
-    return topN
\ No newline at end of file
+# title / anchor score: each document gets 1 / len(query_tokens) for every query token whose postings
+# ({token: (doc_ids, tfs)}) contain it. returns the top N (doc_ids, scores), ties keep the order the documents were
+# first seen in (query token order, then posting order)
+def get_binary_score(query_tokens, postings, N=100):
+    token_doc_ids = [postings[token][0] for token in query_tokens if token in postings]
+    if not token_doc_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    
+    doc_ids, first_seen = np.unique(np.concatenate(token_doc_ids), return_index=True)
+    scores = np.zeros(len(doc_ids))
+    for term_doc_ids in token_doc_ids:
+        scores[np.searchsorted(doc_ids, term_doc_ids)] += 1 / len(query_tokens)
+    
+    order = np.argsort(first_seen, kind='stable')
+    top = order[np.argsort(-scores[order], kind='stable')[:N]]
+    return doc_ids[top], scores[top]
@@ -0,0 +1,89 @@
+# compression ratio and encode/decode speed of the posting formats in posting_codec
+#
+# usage: python benchmarks/posting_codec_bench.py [--sizes 100 10000 1000000] [--repeat 5] [--json]
+
+#imports
+from pathlib import Path
+import argparse
+import json
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import posting_codec
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- doc ids are drawn from the range of wiki ids --- #
+MAX_DOC_ID = 70_000_000
+
+FORMATS = {'fixed': posting_codec.FORMAT_FIXED, 'varbyte': posting_codec.FORMAT_VARBYTE}
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# sorted doc ids and small, geometric tfs, like the postings written by reduce_word_counts
+def synthetic_posting_list(n, rng):
+    doc_ids = np.unique(rng.integers(0, MAX_DOC_ID, n))
+    tfs = rng.geometric(0.5, len(doc_ids))
+    return doc_ids, tfs
+
+
+# best time of repeat runs of fn
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t_start)
+    return min(times)
+
+
+def run(sizes, repeat, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in sizes:
+        doc_ids, tfs = synthetic_posting_list(n, rng)
+        fixed_size = len(posting_codec.encode(doc_ids, tfs, posting_codec.FORMAT_FIXED))
+        for name, posting_format in FORMATS.items():
+            b = posting_codec.encode(doc_ids, tfs, posting_format)
+            decoded = posting_codec.decode(b, len(doc_ids), posting_format)
+            assert (decoded[0] == doc_ids).all() and (decoded[1] == tfs).all()
+            encode_time = best_time(lambda: posting_codec.encode(doc_ids, tfs, posting_format), repeat)
+            decode_time = best_time(lambda: posting_codec.decode(b, len(doc_ids), posting_format), repeat)
+            results.append({'format': name, 'postings': len(doc_ids), 'bytes': len(b),
+                            'bytes_per_posting': len(b) / len(doc_ids),
+                            'compression_ratio': fixed_size / len(b),
+                            'encode_s': encode_time, 'decode_s': decode_time,
+                            'decode_postings_per_s': len(doc_ids) / decode_time})
+    return results
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the posting formats of posting_codec.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'format':<8} {'postings':>10} {'bytes/posting':>14} {'ratio':>6} {'encode ms':>10} {'decode ms':>10} {'Mpostings/s':>12}")
+        for r in results:
+            print(f"{r['format']:<8} {r['postings']:>10} {r['bytes_per_posting']:>14.2f} {r['compression_ratio']:>6.2f} "
+                  f"{r['encode_s'] * 1000:>10.2f} {r['decode_s'] * 1000:>10.2f} {r['decode_postings_per_s'] / 1e6:>12.1f}")
@@ -0,0 +1,325 @@
+# latency and throughput of query evaluation (backend + inverted_index) on a synthetic Zipfian index on local disk
+#
+# usage: python benchmarks/search_bench.py [--docs 20000] [--vocab 50000] [--queries ideal QUERY_FILE ...]
+#                                          [--synthetic 200] [--concurrency 1 4 16] [--passes 2] [--cold]
+#                                          [--backend local|mmap] [--dir DIR] [--json] [--out FILE]
+#                                          [--baseline FILE] [--tolerance 0.2]
+#
+# the words of the replayed queries are part of the synthetic vocabulary, so real query sets (ideal.json, captured
+# logs with one query per line) hit postings of realistic lengths. queries are analyzed like search_frontend does:
+# the body is scored with all words, the title with the stems of the words without stopwords (the title index is
+# built from the stems of the vocabulary), and the anchor with the words without stopwords.
+# every stage reports the bytes read from the storage backend and the growth of the peak RSS while it ran. both are
+# process-wide, so they are only charged to the right stage at concurrency 1. reads of the mmap backend go through the
+# page cache and are not counted
+
+#imports
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import inverted_index
+from inverted_index import InvertedIndex, token2bucket_id
+import backend
+from backend import BUCKET_NAME
+from analyzer import words, get_analyzer
+from doc_stats import DocStats, DocLengths
+from retrieval import fetch_fields
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Synthetic corpus shape --- #
+# Zipf-Mandelbrot term distribution, and log-normal field lengths (in tokens)
+ZIPF_EXPONENT = 1.1
+ZIPF_OFFSET = 2.7
+FIELD_LENGTHS = {'body': (5.5, 0.8), 'title': (1.2, 0.5), 'anchor': (2.0, 1.0)}
+
+IDEAL_QUERIES = Path(__file__).resolve().parent.parent / 'ideal.json'
+
+STAGES = ('analyze', 'fetch', 'body', 'title', 'anchor', 'total')
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# queries from ideal.json ('ideal'), a JSON file (list, or dict keyed by query) or a text file with one query per line
+def load_queries(sources):
+    queries = []
+    for source in sources:
+        path = IDEAL_QUERIES if source == 'ideal' else Path(source)
+        if path.suffix == '.json':
+            with open(path) as f:
+                queries.extend(json.load(f))
+        else:
+            with open(path) as f:
+                queries.extend(line.strip() for line in f if line.strip())
+    return queries
+
+
+# vocabulary by rank: the query words are spread over the ranks, the other terms are synthetic
+def make_vocabulary(n_terms, queries, rng):
+    vocab = [f'term{rank}' for rank in range(n_terms)]
+    query_words = list(dict.fromkeys(word for query in queries for word in words(query)))
+    ranks = rng.choice(n_terms, size=min(len(query_words), n_terms), replace=False)
+    for word, rank in zip(query_words, ranks.tolist()):
+        vocab[rank] = word
+    return vocab
+
+
+# term ranks of every (doc, token) of a field, drawn from the Zipf-Mandelbrot distribution
+def make_field(n_docs, n_terms, field, rng):
+    probabilities = 1 / (np.arange(n_terms) + ZIPF_OFFSET) ** ZIPF_EXPONENT
+    probabilities /= probabilities.sum()
+    mean, sigma = FIELD_LENGTHS[field]
+    lengths = np.maximum(rng.lognormal(mean, sigma, n_docs).astype(np.int64), 1)
+    doc_ids = np.repeat(np.arange(1, n_docs + 1), lengths)
+    return doc_ids, rng.choice(n_terms, size=len(doc_ids), p=probabilities)
+
+
+# write the index of one field in the InvertedIndex format, like IndexBuilder.ipynb does
+def build_index(doc_ids, terms, vocab, ii_name, work_dir):
+    keys, tfs = np.unique(terms * (doc_ids.max() + 1) + doc_ids, return_counts=True)
+    term_of, doc_of = np.divmod(keys, doc_ids.max() + 1)
+    starts = np.flatnonzero(np.r_[True, term_of[1:] != term_of[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+
+    index = InvertedIndex()
+    index.DL = dict(Counter(doc_ids.tolist()))
+    buckets = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        w = vocab[term_of[start]]
+        pl = list(zip(doc_of[start:end].tolist(), tfs[start:end].tolist()))
+        index.df[w] = len(pl)
+        index.term_total[w] = int(tfs[start:end].sum())
+        term_max, block_max = InvertedIndex.get_score_bounds(pl, index.DL)
+        index.term_max[w] = term_max
+        if block_max is not None:
+            index.block_max[w] = block_max
+        buckets.setdefault(token2bucket_id(w), []).append((w, pl))
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        for bucket_id, list_w_pl in buckets.items():
+            InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), BUCKET_NAME, ii_name)
+            with open(Path(inverted_index.INDEX_DIR) / ii_name / f'{bucket_id}_posting_locs.pickle', 'rb') as f:
+                index.posting_locs.update(pickle.load(f))
+    finally:
+        os.chdir(cwd)
+    return index
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bytes_read():
+    readers = list(inverted_index._readers.values())
+    return sum(reader.bytes_read for reader in readers), sum(reader.requests for reader in readers)
+
+
+# (time, peak RSS, bytes read) now, the difference of two marks is charged to the stage between them
+def mark():
+    return time.perf_counter(), peak_rss(), bytes_read()[0]
+
+
+def stage_usage(start, end):
+    return {'seconds': end[0] - start[0], 'rss_growth': end[1] - start[1], 'bytes_read': end[2] - start[2]}
+
+
+# latency percentiles of a list of seconds, in milliseconds
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)),
+            'p99': float(np.percentile(ms, 99)), 'mean': float(ms.mean())}
+
+
+
+#######################################################################################################################
+################################################# Query Evaluation ####################################################
+
+
+# the retrieval and scoring stages of the /search route, with the time, RSS growth and bytes read of each stage
+def run_query(query, indexes, analyzer):
+    body_index, title_index, anchor_index = indexes
+    usage = {}
+    start = mark()
+
+    # analyzed like search_frontend.analyze_query
+    query_words = analyzer.words(query)
+    query_tokens = [token for token in query_words if token not in analyzer.stopwords]
+    stems = analyzer.stems(query_tokens)
+    body_needed = backend.get_needed_postings(query_words, body_index, body_index.term_total.keys())
+    analyzed = mark()
+    usage['analyze'] = stage_usage(start, analyzed)
+
+    fetches = {
+        'body': lambda: backend.read_needed_postings(body_index, body_needed),
+        'title': lambda: title_index.read_posting_arrays(list(dict.fromkeys(stems)), 'title', BUCKET_NAME),
+        'anchor': lambda: anchor_index.read_posting_arrays(list(dict.fromkeys(query_tokens)), 'anchor', BUCKET_NAME),
+    }
+    postings = dict(fetch_fields(fetches))
+    fetched = mark()
+    usage['fetch'] = stage_usage(analyzed, fetched)
+
+    backend.get_body_tfidf_score(query_words, body_index, 100, postings['body'])
+    body = mark()
+    usage['body'] = stage_usage(fetched, body)
+    backend.get_binary_score(stems, postings['title'], 100)
+    title = mark()
+    usage['title'] = stage_usage(body, title)
+    backend.get_binary_score(query_tokens, postings['anchor'], 100)
+    end = mark()
+    usage['anchor'] = stage_usage(title, end)
+    usage['total'] = stage_usage(start, end)
+    return usage
+
+
+# replay the queries passes times with concurrency threads
+def replay(queries, indexes, analyzer, concurrency, passes):
+    bytes_before, requests_before = bytes_read()
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        usages = list(pool.map(lambda query: run_query(query, indexes, analyzer), queries * passes))
+    wall = time.perf_counter() - t_start
+    bytes_after, requests_after = bytes_read()
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = percentiles([usage[stage]['seconds'] for usage in usages])
+        stages[stage]['bytes_read'] = sum(usage[stage]['bytes_read'] for usage in usages)
+        stages[stage]['rss_growth'] = sum(usage[stage]['rss_growth'] for usage in usages)
+    return {'concurrency': concurrency, 'queries': len(usages), 'seconds': wall, 'qps': len(usages) / wall,
+            'stages': stages, 'bytes_read': bytes_after - bytes_before, 'read_requests': requests_after - requests_before,
+            'peak_rss': peak_rss()}
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    queries = load_queries(args.queries)
+    vocab = make_vocabulary(args.vocab, queries, rng)
+    probabilities = 1 / (np.arange(args.vocab) + ZIPF_OFFSET) ** ZIPF_EXPONENT
+    probabilities /= probabilities.sum()
+    for _ in range(args.synthetic):
+        queries.append(' '.join(vocab[rank] for rank in rng.choice(args.vocab, size=rng.integers(1, 5), p=probabilities)))
+
+    work_dir = Path(args.dir or tempfile.mkdtemp(prefix='search_bench_'))
+    inverted_index.INDEX_DIR = str(work_dir / 'bucket')
+    inverted_index.STORAGE_BACKEND = args.backend
+
+    # build, the title index holds the stems of the vocabulary (words with the same stem are one term)
+    analyzer = get_analyzer()
+    stems = analyzer.stems(vocab)
+    stem_vocab = list(dict.fromkeys(stems))
+    stem_ids = {stem: stem_id for stem_id, stem in enumerate(stem_vocab)}
+    stem_of = np.array([stem_ids[stem] for stem in stems])
+    t_start = time.perf_counter()
+    indexes = []
+    for field in ('body', 'title', 'anchor'):
+        doc_ids, terms = make_field(args.docs, args.vocab, field, rng)
+        if field == 'title':
+            indexes.append(build_index(doc_ids, stem_of[terms], stem_vocab, field, work_dir))
+        else:
+            indexes.append(build_index(doc_ids, terms, vocab, field, work_dir))
+    build = {'seconds': time.perf_counter() - t_start, 'peak_rss': peak_rss(),
+             'postings': {field: int(sum(index.df.values())) for field, index in zip(('body', 'title', 'anchor'), indexes)},
+             'bytes': sum(f.stat().st_size for f in (work_dir / 'bucket').rglob('*.bin'))}
+
+    # the frontend reads document lengths from doc stats
+    pr = {str(doc_id): float(rank) for doc_id, rank in enumerate(rng.pareto(1.5, args.docs), 1)}
+    stats = DocStats.build({field: index.DL for field, index in zip(('body', 'title', 'anchor'), indexes)}, pr)
+    for field, index in zip(('body', 'title', 'anchor'), indexes):
+        index.DL = DocLengths(stats, f'dl_{field}')
+
+    runs = []
+    for concurrency in args.concurrency:
+        if args.cold:
+            inverted_index.BLOCK_CACHE.clear()
+            inverted_index.POSTING_CACHE.clear()
+        runs.append(replay(queries, indexes, analyzer, concurrency, args.passes))
+
+    config = {key: value for key, value in vars(args).items() if key not in ('json', 'out', 'baseline')}
+    return {'config': config, 'build': build, 'runs': runs}
+
+
+# stages whose p95 latency got worse than the baseline by more than tolerance, per concurrency
+def regressions(results, baseline, tolerance):
+    found = []
+    base_runs = {run['concurrency']: run for run in baseline['runs']}
+    for run in results['runs']:
+        base = base_runs.get(run['concurrency'])
+        if base is None:
+            continue
+        for stage in STAGES:
+            before, after = base['stages'][stage]['p95'], run['stages'][stage]['p95']
+            if after > before * (1 + tolerance):
+                found.append({'concurrency': run['concurrency'], 'stage': stage, 'baseline_p95': before, 'p95': after})
+        if run['qps'] < base['qps'] / (1 + tolerance):
+            found.append({'concurrency': run['concurrency'], 'stage': 'qps', 'baseline_qps': base['qps'], 'qps': run['qps']})
+    return found
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark query evaluation on a synthetic local index.')
+    parser.add_argument('--docs', type=int, default=20_000)
+    parser.add_argument('--vocab', type=int, default=50_000)
+    parser.add_argument('--queries', nargs='*', default=['ideal'], help="'ideal', JSON files or query logs")
+    parser.add_argument('--synthetic', type=int, default=200, help='random Zipfian queries added to the query set')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--passes', type=int, default=2, help='times each query set is replayed per concurrency')
+    parser.add_argument('--cold', action='store_true', help='clear the posting caches before each concurrency')
+    parser.add_argument('--backend', choices=['local', 'mmap'], default='local')
+    parser.add_argument('--dir', help='directory for the synthetic index (default: a new temp dir)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    parser.add_argument('--out', help='also write the results to this JSON file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = regressions(results, json.load(f), args.tolerance)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        build = results['build']
+        print(f"build: {build['seconds']:.1f}s, {sum(build['postings'].values())} postings, {build['bytes'] / 2 ** 20:.1f} MiB, "
+              f"peak RSS {build['peak_rss'] / 2 ** 20:.0f} MiB")
+        print(f"{'conc':>4} {'qps':>8} {'stage':<8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'MiB read':>9} {'+RSS MiB':>9}")
+        for r in results['runs']:
+            for stage in STAGES:
+                s = r['stages'][stage]
+                print(f"{r['concurrency']:>4} {r['qps']:>8.1f} {stage:<8} {s['p50']:>8.2f} {s['p95']:>8.2f} {s['p99']:>8.2f} "
+                      f"{s['bytes_read'] / 2 ** 20:>9.1f} {s['rss_growth'] / 2 ** 20:>9.1f}")
+            print(f"{r['concurrency']:>4} peak RSS {r['peak_rss'] / 2 ** 20:.0f} MiB, {r['bytes_read'] / 2 ** 20:.1f} MiB read "
+                  f"in {r['read_requests']} requests")
+        for regression in results.get('regressions', []):
+            print(f"REGRESSION: {regression}")
+    if results.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,178 @@
+#imports
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from pathlib import Path
+from inverted_index import get_backend
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Bootstrap settings --- #
+# artifacts loaded at the same time, and attempts per artifact (interrupted downloads resume, so retries are cheap)
+BOOTSTRAP_WORKERS = int(os.environ.get('IR_BOOTSTRAP_WORKERS', 4))
+BOOTSTRAP_RETRIES = int(os.environ.get('IR_BOOTSTRAP_RETRIES', 3))
+
+# --- Local copies --- #
+# directory the frontends keep their local copies of the indexes and pr.json in (created on the first download)
+LOCAL_DIR = os.environ.get('IR_LOCAL_DIR', '/Indexes')
+
+# --- Artifact states --- #
+PENDING = 'pending'
+LOADING = 'loading'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# --- Local copy of a bucket file, downloaded (resumably) only when local_path doesn't exist yet --- #
+def fetch(bucket_name, path, local_path):
+    if os.path.exists(local_path):
+        print(f"{local_path} already exists.")
+        return Path(local_path)
+    return get_backend(bucket_name).local_path(path, local_path)
+
+
+
+#######################################################################################################################
+################################################ Bootstrap Class ######################################################
+
+
+# loads named startup artifacts concurrently in a background thread. each artifact has a loader called with the
+# loaded values of its dependencies, and is started as soon as they are done
+class Bootstrap:
+    def __init__(self, max_workers=BOOTSTRAP_WORKERS, retries=BOOTSTRAP_RETRIES):
+        self.max_workers = max_workers
+        self.retries = retries
+        self._loaders = {}
+        self.results = {}
+        self.states = {}
+        self.timings = {}
+        self.errors = {}
+        self._on_ready = []
+        self._ready = threading.Event()
+        # set once the bootstrap is over, whether it succeeded or failed
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+
+    def add(self, name, loader, deps=()):
+        self._loaders[name] = (loader, tuple(deps))
+        self.states[name] = PENDING
+
+
+    # callbacks run with the {name: value} results once everything is loaded, before ready() turns true
+    def on_ready(self, callback):
+        self._on_ready.append(callback)
+
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='bootstrap', daemon=True)
+        thread.start()
+        return thread
+
+
+    def ready(self):
+        return self._ready.is_set()
+
+
+    def failed(self):
+        return bool(self.errors)
+
+
+    def done(self):
+        return self._done.is_set()
+
+
+    # wait until the bootstrap is over (or timeout), returns whether it succeeded. check failed() on False
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.ready()
+
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+
+    # per-artifact state and load time, for the health endpoints
+    def status(self):
+        with self._lock:
+            artifacts = {name: {'state': state, 'seconds': round(self.timings.get(name, 0.0), 3)}
+                         for name, state in self.states.items()}
+            for name, error in self.errors.items():
+                artifacts[name]['error'] = error
+        return {'ready': self.ready(), 'artifacts': artifacts}
+
+
+    def _run(self):
+        try:
+            self._load_all()
+        except Exception as e:
+            with self._lock:
+                self.errors['bootstrap'] = repr(e)
+            print(f"Bootstrap failed: {self.errors}")
+        finally:
+            self._done.set()
+
+
+    def _load_all(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bootstrap') as pool:
+            futures = {}
+            while len(futures) < len(self._loaders):
+                # submit every artifact whose dependencies are done
+                runnable = [name for name, (_, deps) in self._loaders.items()
+                            if name not in futures and all(self.states[dep] == DONE for dep in deps)]
+                for name in runnable:
+                    loader, deps = self._loaders[name]
+                    futures[name] = pool.submit(self._load, name, loader, deps)
+                if not runnable and all(future.done() for future in futures.values()):
+                    # the rest depend on an artifact that failed
+                    break
+                time.sleep(0.05)
+        
+        if self.errors or len(self.results) < len(self._loaders):
+            print(f"Bootstrap failed: {self.errors}")
+            return
+        try:
+            for callback in self._on_ready:
+                callback(self.results)
+        except Exception as e:
+            with self._lock:
+                self.errors['on_ready'] = repr(e)
+            print(f"Bootstrap failed: {self.errors}")
+            return
+        self._ready.set()
+        print(f"Bootstrap done in {time.perf_counter() - start:.1f}s: "
+              + ', '.join(f"{name} {seconds:.1f}s" for name, seconds in self.timings.items()))
+
+
+    def _load(self, name, loader, deps):
+        with self._lock:
+            self.states[name] = LOADING
+        start = time.perf_counter()
+        for attempt in range(1, self.retries + 1):
+            try:
+                value = loader(*[self.results[dep] for dep in deps])
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    with self._lock:
+                        self.states[name] = FAILED
+                        self.errors[name] = repr(e)
+                    return
+                print(f"Loading {name} failed ({e!r}), retrying.")
+                time.sleep(2 ** attempt)
+        
+        with self._lock:
+            self.results[name] = value
+            self.timings[name] = time.perf_counter() - start
+            self.states[name] = DONE
@@ -0,0 +1,265 @@
+#imports
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+import argparse
+import heapq
+import itertools
+import json
+import os
+import pickle
+import shutil
+import time
+import numpy as np
+from inverted_index import InvertedIndex, MultiFileWriter, NUM_BUCKETS, get_backend, token2bucket_id
+import posting_codec
+from doc_stats import DocStats
+from analyzer import get_analyzer
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Bucket name --- #
+BUCKET_NAME = "ir_project__bucket1"
+
+# --- Fields --- #
+# parquet column of each field, and the smallest df kept (IndexBuilder.ipynb keeps body terms with more than 50
+# postings and anchor terms with more than 20)
+COLUMNS = {'body': 'text', 'title': 'title', 'anchor': 'anchor_text'}
+MIN_DF = {'body': 51, 'title': 1, 'anchor': 21}
+# posting format of each field. only fixed-size postings can be read block by block, which the body's block-max
+# pruning needs (see backend.get_needed_postings), so the body stays fixed. title and anchor postings are always read
+# whole, and stay fixed like the indexes IndexBuilder.ipynb builds
+FORMATS = {'body': 'fixed', 'title': 'fixed', 'anchor': 'fixed'}
+
+# --- Builder defaults --- #
+# docs per tokenizer task, and postings held in memory before a sorted run is spilled to disk
+BATCH_SIZE = 1000
+MAX_POSTINGS = 20_000_000
+POSTING_FORMATS = {'fixed': posting_codec.FORMAT_FIXED, 'varbyte': posting_codec.FORMAT_VARBYTE}
+
+
+
+#######################################################################################################################
+############################################### Tokenizer Workers #####################################################
+
+
+# the analyzer (see analyzer.py) is set up once per worker process
+def init_worker():
+    get_analyzer()
+
+
+# text of a field value, anchor_text is a list of (id, text) rows
+def field_text(field, value):
+    if value is None:
+        return ''
+    if field == 'anchor':
+        return ' '.join((row['text'] if isinstance(row, dict) else row[1]) or '' for row in value)
+    return value
+
+
+# (doc_ids, DLs, [(term, doc_id, tf)]) of a batch of (doc_id, value) pairs, terms are made like get_tf /
+# get_title_tf / get_anchor_tf of IndexBuilder.ipynb (titles are stemmed)
+def tokenize_batch(field, doc_ids, values):
+    analyzed = get_analyzer().analyze_batch([field_text(field, value) for value in values], stem=field == 'title')
+    DLs = []
+    postings = []
+    for doc_id, (tokens, stems, counts) in zip(doc_ids, analyzed):
+        DLs.append(len(tokens))
+        postings.extend((term, doc_id, tf) for term, tf in counts.items())
+    return doc_ids, DLs, postings
+
+
+
+#######################################################################################################################
+################################################ Builder Functions ####################################################
+
+
+# (doc_ids, values) batches of a field from the parquet files, read a record batch at a time
+def read_batches(paths, field, batch_size):
+    import pyarrow.parquet as pq
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['id', COLUMNS[field]]):
+            yield batch.column('id').to_pylist(), batch.column(COLUMNS[field]).to_pylist()
+
+
+# parquet files of the input paths (files or directories)
+def parquet_paths(inputs):
+    paths = []
+    for path in map(Path, inputs):
+        paths.extend(sorted(path.rglob('*.parquet')) if path.is_dir() else [path])
+    return paths
+
+
+# write the in-memory postings as a run file sorted by term, each record is (term, doc_ids, tfs)
+def spill(postings, run_path):
+    with open(run_path, 'wb') as f:
+        for term in sorted(postings):
+            doc_ids, tfs = postings[term]
+            pickle.dump((term, np.frombuffer(doc_ids, dtype=np.int64), np.frombuffer(tfs, dtype=np.uint32)), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(run_path):
+    with open(run_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+# SPIMI inversion: tokenize batches in a process pool (at most 2 * workers batches in flight), invert them in memory
+# and spill a sorted run whenever max_postings are held. returns the run files and the {doc_id: DL} dict
+def invert(paths, field, work_dir, workers, batch_size, max_postings):
+    runs = []
+    DL = {}
+    postings = defaultdict(lambda: (array('q'), array('I')))
+    n_postings = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        batches = read_batches(paths, field, batch_size)
+        pending = [pool.submit(tokenize_batch, field, *batch) for batch in itertools.islice(batches, 2 * workers)]
+        while pending:
+            doc_ids, DLs, batch_postings = pending.pop(0).result()
+            for batch in itertools.islice(batches, 1):
+                pending.append(pool.submit(tokenize_batch, field, *batch))
+
+            DL.update(zip(doc_ids, DLs))
+            for term, doc_id, tf in batch_postings:
+                term_doc_ids, term_tfs = postings[term]
+                term_doc_ids.append(doc_id)
+                term_tfs.append(tf)
+            n_postings += len(batch_postings)
+            if n_postings >= max_postings:
+                runs.append(work_dir / f'{field}_run_{len(runs):04}.pkl')
+                spill(postings, runs[-1])
+                postings.clear()
+                n_postings = 0
+
+    if postings:
+        runs.append(work_dir / f'{field}_run_{len(runs):04}.pkl')
+        spill(postings, runs[-1])
+    return runs, DL
+
+
+# k-way merge of the sorted runs, yields (term, doc_ids, tfs) with the postings of a term sorted by doc id
+def merge_runs(runs):
+    merged = heapq.merge(*(read_run(run) for run in runs), key=lambda record: record[0])
+    for term, records in itertools.groupby(merged, key=lambda record: record[0]):
+        records = list(records)
+        doc_ids = np.concatenate([record[1] for record in records])
+        tfs = np.concatenate([record[2] for record in records]).astype(np.int64)
+        order = np.argsort(doc_ids, kind='stable')
+        yield term, doc_ids[order], tfs[order]
+
+
+# write the merged postings of a field with a MultiFileWriter per bucket, and return its InvertedIndex. the posting
+# files and posting locs of the field are written to work_dir/field, so no other field's files can be uploaded with
+# them. a writer per bucket stays open for the whole merge, so up to NUM_BUCKETS posting files are open at once, on
+# top of the open runs of the field
+def write_field(runs, DL, field, bucket_name, work_dir, posting_format, min_df):
+    field_dir = Path(work_dir) / field
+    field_dir.mkdir(parents=True, exist_ok=True)
+    index = InvertedIndex()
+    index.DL = DL
+    index.posting_format = posting_format
+    stats = DocStats.build({field: DL}, {})
+    writers = {}
+    bucket_locs = defaultdict(lambda: defaultdict(list))
+    # the writers are closed on the way out, after an error the uploads still in flight are waited for
+    with ExitStack() as stack:
+        for term, doc_ids, tfs in merge_runs(runs):
+            if len(doc_ids) < min_df:
+                continue
+            bucket_id = token2bucket_id(term)
+            if bucket_id not in writers:
+                writers[bucket_id] = stack.enter_context(MultiFileWriter(field_dir, bucket_id, bucket_name, field))
+            b = posting_codec.encode(doc_ids, tfs, posting_format)
+            bucket_locs[bucket_id][term].extend(writers[bucket_id].write(b))
+            index.df[term] = len(doc_ids)
+            index.term_total[term] = int(tfs.sum())
+            if posting_format != posting_codec.FORMAT_FIXED:
+                index.posting_nbytes[term] = len(b)
+            if field == 'body':
+                term_max, block_max = InvertedIndex.get_tf_bounds(tfs, stats.gather(f'dl_{field}', doc_ids).astype(np.float64))
+                index.term_max[term] = term_max
+                # blocks can only be read on their own from fixed-size postings
+                if block_max is not None and posting_format == posting_codec.FORMAT_FIXED:
+                    index.block_max[term] = block_max
+
+        for bucket_id, writer in writers.items():
+            writer.upload_to_gcp()
+            index.posting_locs.update(bucket_locs[bucket_id])
+            InvertedIndex._upload_posting_locs(bucket_id, bucket_locs[bucket_id], bucket_name, field, field_dir)
+    return index
+
+
+def build(args):
+    paths = parquet_paths(args.input)
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for field in args.fields:
+        t_start = time.time()
+        runs, DL = invert(paths, field, work_dir, args.workers, args.batch_size, args.max_postings)
+        t_inverted = time.time()
+        index = write_field(runs, DL, field, args.bucket, work_dir, POSTING_FORMATS[args.format or FORMATS[field]], args.min_df.get(field, MIN_DF[field]))
+        index.write_index(out_dir, f'{field}_index')
+        get_backend(args.bucket).upload(out_dir / f'{field}_index.pkl', f'{field}/{field}_index.pkl')
+        print(f"{field}: {len(DL)} docs, {len(index.df)} terms, {sum(index.df.values())} postings, {len(runs)} runs, "
+              f"inverted in {t_inverted - t_start:.0f}s, merged and written in {time.time() - t_inverted:.0f}s")
+        for run in runs:
+            os.remove(run)
+
+    if args.titles:
+        import pyarrow.parquet as pq
+        titles = {}
+        for path in paths:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=args.batch_size, columns=['id', 'title']):
+                titles.update(zip(map(str, batch.column('id').to_pylist()), batch.column('title').to_pylist()))
+        with open(out_dir / 'titles.json', 'w') as f:
+            json.dump(titles, f)
+        get_backend(args.bucket).upload(out_dir / 'titles.json', 'titles/titles.json')
+
+    if not args.keep_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+# build indexes on one machine, without Spark:
+#   IR_INDEX_DIR=/data/bucket python build_index.py /data/wiki/*.parquet --fields body title anchor --titles
+# postings, posting locs and {field}_index.pkl are written through the configured storage backend, laid out like
+# the output of IndexBuilder.ipynb, so search_frontend.py loads them unchanged
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build inverted indexes from wiki parquet files on a single node.')
+    parser.add_argument('input', nargs='+', help='parquet files or directories of them')
+    parser.add_argument('--fields', nargs='+', choices=list(COLUMNS), default=list(COLUMNS))
+    parser.add_argument('--bucket', default=BUCKET_NAME)
+    parser.add_argument('--format', choices=list(POSTING_FORMATS),
+                        help='posting format of every field (default: fixed, varbyte turns off block pruning of the body)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='documents per tokenizer task')
+    parser.add_argument('--max-postings', type=int, default=MAX_POSTINGS,
+                        help='postings held in memory before a sorted run is spilled to disk')
+    parser.add_argument('--min-df', type=json.loads, default={}, help='JSON {field: min df}, overrides the defaults')
+    parser.add_argument('--work-dir', default='build_runs',
+                        help='directory for runs, and for the posting files being written (a subdirectory per field). '
+                             f'while a field is merged, all its runs and up to {NUM_BUCKETS} posting files are open at once')
+    parser.add_argument('--keep-work-dir', action='store_true')
+    parser.add_argument('--out-dir', default='.', help='local directory for {field}_index.pkl and titles.json')
+    parser.add_argument('--titles', action='store_true', help='also write titles.json')
+    args = parser.parse_args()
+
+    build(args)
@@ -0,0 +1,169 @@
+#imports
+from pathlib import Path
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Column sentinels --- #
+# document lengths are stored as int32 with MISSING_LENGTH for documents absent from a field's DL,
+# float columns (PageRank) use NaN
+MISSING_LENGTH = -1
+
+# --- Column names --- #
+FIELDS = ('body', 'title', 'anchor')
+
+
+
+#######################################################################################################################
+################################################# DocStats Class ######################################################
+
+
+# wiki ids mapped to dense ordinals, with per-document columns in contiguous NumPy arrays
+class DocStats:
+    def __init__(self, doc_ids, columns):
+        # sorted wiki ids, the position of an id is its ordinal
+        self.doc_ids = doc_ids
+        # column name -> array aligned with doc_ids
+        self.columns = columns
+
+
+    # ordinals of doc_ids, and a mask of the ids that are known
+    def ordinals(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        ordinals = np.searchsorted(self.doc_ids, doc_ids)
+        ordinals[ordinals == len(self.doc_ids)] = 0
+        found = self.doc_ids[ordinals] == doc_ids if len(self.doc_ids) else np.zeros(len(doc_ids), dtype=bool)
+        return ordinals, found
+
+
+    # values of a column for doc_ids, default for unknown ids
+    def gather(self, name, doc_ids, default=0):
+        ordinals, found = self.ordinals(doc_ids)
+        column = self.columns[name]
+        values = column[ordinals] if len(column) else np.zeros(len(ordinals), dtype=column.dtype)
+        return np.where(found, values, default)
+
+
+    # save as a directory of .npy files, with the version of the files the stats were built from (see saved_version).
+    # the directory is written next to path and swapped in, so processes still mapping the old files keep reading them
+    def save(self, path, version=None):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=f'.{path.name}.'))
+        os.chmod(tmp, 0o755)
+        np.save(tmp / 'doc_ids.npy', self.doc_ids)
+        for name, column in self.columns.items():
+            np.save(tmp / f'{name}.npy', column)
+        with open(tmp / 'columns.json', 'w') as f:
+            json.dump(list(self.columns), f)
+        with open(tmp / 'version.json', 'w') as f:
+            json.dump(version, f)
+        
+        old = path.with_name(f'.{path.name}.old.{os.getpid()}')
+        if path.exists():
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+    # version a saved DocStats was built from, None if it wasn't saved with one (or isn't saved)
+    @staticmethod
+    def saved_version(path):
+        try:
+            with open(Path(path) / 'version.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+    # load a saved DocStats, memory-mapped by default so workers share the pages
+    @staticmethod
+    def load(path, mmap=True):
+        path = Path(path)
+        mmap_mode = 'r' if mmap else None
+        with open(path / 'columns.json') as f:
+            names = json.load(f)
+        columns = {name: np.load(path / f'{name}.npy', mmap_mode=mmap_mode) for name in names}
+        return DocStats(np.load(path / 'doc_ids.npy', mmap_mode=mmap_mode), columns)
+
+
+    # build from the DL dicts of the indexes ({field: {doc_id: length}}) and the PageRank dict ({str(doc_id): pr})
+    @staticmethod
+    def build(DLs, pr):
+        pr_ids = np.fromiter((int(doc_id) for doc_id in pr.keys()), dtype=np.int64, count=len(pr))
+        all_ids = [pr_ids] + [np.fromiter(DL.keys(), dtype=np.int64, count=len(DL)) for DL in DLs.values()]
+        doc_ids = np.unique(np.concatenate(all_ids))
+        stats = DocStats(doc_ids, {})
+        
+        for field, DL in DLs.items():
+            column = np.full(len(doc_ids), MISSING_LENGTH, dtype=np.int32)
+            ordinals, _ = stats.ordinals(np.fromiter(DL.keys(), dtype=np.int64, count=len(DL)))
+            column[ordinals] = np.fromiter(DL.values(), dtype=np.int32, count=len(DL))
+            stats.columns[f'dl_{field}'] = column
+        
+        column = np.full(len(doc_ids), np.nan)
+        column[stats.ordinals(pr_ids)[0]] = np.fromiter(pr.values(), dtype=np.float64, count=len(pr))
+        stats.columns['pr'] = column
+        return stats
+
+
+
+#######################################################################################################################
+################################################ DocLengths Class #####################################################
+
+
+# read-only {doc_id: length} view over a DocStats column, used in place of an index's DL dict
+class DocLengths:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self._n_docs = int(np.count_nonzero(np.asarray(stats.columns[name]) != MISSING_LENGTH))
+
+
+    # lengths of doc_ids as floats, 0 for documents missing from the field
+    def lookup(self, doc_ids):
+        lengths = self.stats.gather(self.name, doc_ids, MISSING_LENGTH).astype(np.float64)
+        lengths[lengths == MISSING_LENGTH] = 0
+        return lengths
+
+
+    def get(self, doc_id, default=None):
+        length = int(self.stats.gather(self.name, [doc_id], MISSING_LENGTH)[0])
+        return default if length == MISSING_LENGTH else length
+
+
+    def __getitem__(self, doc_id):
+        length = self.get(doc_id)
+        if length is None:
+            raise KeyError(doc_id)
+        return length
+
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+
+    def __len__(self):
+        return self._n_docs
+
+
+    def keys(self):
+        return self
+
+
+    def __iter__(self):
+        column = np.asarray(self.stats.columns[self.name])
+        return iter(self.stats.doc_ids[column != MISSING_LENGTH].tolist())
+
+
+    def values(self):
+        column = np.asarray(self.stats.columns[self.name])
+        return iter(column[column != MISSING_LENGTH].tolist())
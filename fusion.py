@@ -0,0 +1,90 @@
+#imports
+import math
+import numpy as np
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Fields --- #
+# fused fields, in the order their weighted scores are added up. weights are given in the same order
+FIELDS = ('body', 'title', 'anchor', 'pr')
+# weights of the frontends, when a request doesn't pass its own
+DEFAULT_WEIGHTS = (0.35, 0.35, 0.05, 0.25)
+
+# --- Results --- #
+TOP_K = 100
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# weights from a "body,title,anchor,pr" string (like the weights parameter of /search), or a list of 4 numbers.
+# None or an empty string gives the default weights, anything else but 4 finite, non-negative numbers raises ValueError
+def parse_weights(value, default=DEFAULT_WEIGHTS):
+    if value is None or value == '':
+        return tuple(default)
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)) or len(value) != len(FIELDS):
+        raise ValueError(f'expected {len(FIELDS)} weights ({",".join(FIELDS)})')
+    try:
+        weights = tuple(float(weight) for weight in value)
+    except (TypeError, ValueError):
+        raise ValueError(f'weights must be numbers, got {value!r}') from None
+    if not all(math.isfinite(weight) and weight >= 0 for weight in weights):
+        raise ValueError(f'weights must be finite and non-negative, got {value!r}')
+    return weights
+
+
+# all candidates of the field results ({field: (doc_ids, scores)} of body, title and anchor), sorted, and the weighted
+# score of each field (and page rank) for them. each field's scores are normalized by its maximum score, page rank by
+# the maximum page rank of the candidates. a field whose maximum score isn't positive contributes 0, never nan
+def get_components(results, doc_stats, weights=DEFAULT_WEIGHTS):
+    docs = np.unique(np.concatenate([np.asarray(results[field][0], dtype=np.int64) for field in FIELDS[:-1]]))
+    components = {}
+    for field, weight in zip(FIELDS[:-1], weights):
+        doc_ids, scores = results[field]
+        aligned = np.zeros(len(docs))
+        aligned[np.searchsorted(docs, doc_ids)] = scores
+        max_score = scores.max() if len(scores) else 0
+        components[field] = weight * np.divide(aligned, max_score, out=np.zeros(len(docs)), where=max_score > 0)
+
+    prs = doc_stats.gather('pr', docs, np.nan)
+    has_pr = ~np.isnan(prs)
+    max_pr = prs[has_pr].max() if has_pr.any() else 1
+    components['pr'] = np.where(has_pr, weights[-1] * (prs / max_pr), 0)
+    return docs, components
+
+
+# positions of the top k fused scores of the components, best first. the k-th score is found by partial selection and
+# only the scores above it (and the first ties at it) are sorted, ties keep the order of the candidates
+def rank(components, k=TOP_K):
+    scores = components[FIELDS[0]]
+    for field in FIELDS[1:]:
+        scores = scores + components[field]
+    return top_k(scores, k)
+
+
+def top_k(scores, k=TOP_K):
+    keys = -scores
+    if len(keys) <= k:
+        return np.argsort(keys, kind='stable')
+    kth_key = np.partition(keys, k - 1)[k - 1]
+    # nan scores sort last, like in a full sort
+    if np.isnan(kth_key):
+        above, ties = np.flatnonzero(~np.isnan(keys)), np.flatnonzero(np.isnan(keys))
+    else:
+        above, ties = np.flatnonzero(keys < kth_key), np.flatnonzero(keys == kth_key)
+    selected = np.sort(np.concatenate([above, ties[:k - len(above)]]))
+    return selected[np.argsort(keys[selected], kind='stable')]
+
+
+# top k doc ids of the field results fused with page rank
+def fuse(results, doc_stats, weights=DEFAULT_WEIGHTS, k=TOP_K):
+    docs, components = get_components(results, doc_stats, weights)
+    return docs[rank(components, k)]
@@ -0,0 +1,303 @@
+#imports
+from functools import lru_cache
+from pathlib import Path
+import hashlib
+import json
+import pickle
+import sys
+import numpy as np
+from doc_stats import DocStats, DocLengths
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Lexicon files --- #
+# terms are looked up by binary search over the sorted 64-bit hashes of the terms (ties from hash collisions are
+# resolved by comparing the term bytes). all per-term arrays are in hash order; ragged values (posting locations,
+# block maxima, impact segments) are concatenated, with a starts array of n_terms + 1 entries
+ARRAYS = ('hashes', 'term_offsets', 'df', 'term_total', 'loc_starts', 'loc_files', 'loc_offsets')
+OPTIONAL_ARRAYS = ('posting_nbytes', 'term_max', 'block_max', 'block_max_starts', 'impact_segments', 'impact_segments_starts')
+
+# --- Lookup cache --- #
+# a query looks the same term up several times (df, posting_locs, posting size), so recent lookups are memoized
+FIND_CACHE_SIZE = 4096
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# --- 64-bit term hash --- #
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+# starts array (n + 1 entries) of ragged lists
+def _starts(lengths):
+    starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=starts[1:])
+    return starts
+
+
+
+#######################################################################################################################
+################################################# Lexicon Class #######################################################
+
+
+# sorted, memory-mapped term table with packed per-term arrays
+class Lexicon:
+    def __init__(self, path, arrays, terms, files, meta):
+        self.path = Path(path)
+        self.arrays = arrays
+        self._terms = terms
+        self.files = files
+        self.meta = meta
+        self.find = lru_cache(maxsize=FIND_CACHE_SIZE)(self._find)
+
+
+    @staticmethod
+    def open(path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        with open(path / 'files.json') as f:
+            files = json.load(f)
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode='r') for name in ARRAYS + OPTIONAL_ARRAYS
+                  if (path / f'{name}.npy').exists()}
+        terms = np.memmap(path / 'terms.bin', dtype=np.uint8, mode='r') if (path / 'terms.bin').stat().st_size else b''
+        return Lexicon(path, arrays, terms, files, meta)
+
+
+    def __len__(self):
+        return len(self.arrays['hashes'])
+
+
+    # row of term, or -1
+    def _find(self, term):
+        hashes = self.arrays['hashes']
+        h = term_hash(term)
+        row = int(np.searchsorted(hashes, np.uint64(h)))
+        encoded = term.encode('utf8')
+        while row < len(hashes) and int(hashes[row]) == h:
+            if self.term(row, raw=True) == encoded:
+                return row
+            row += 1
+        return -1
+
+
+    def term(self, row, raw=False):
+        offsets = self.arrays['term_offsets']
+        b = bytes(self._terms[offsets[row]:offsets[row + 1]])
+        return b if raw else b.decode('utf8')
+
+
+    def terms(self):
+        return (self.term(row) for row in range(len(self)))
+
+
+    # slice [starts[row], starts[row + 1]) of a ragged array
+    def ragged(self, name, row):
+        starts = self.arrays[f'{name}_starts']
+        return starts[row], starts[row + 1]
+
+
+    # index variables as views over the lexicon, to replace the pickled dicts of an InvertedIndex
+    def index_variables(self):
+        variables = {
+            'DL': DocLengths(DocStats.load(self.path / 'dl'), 'dl'),
+            'df': LexiconColumn(self, 'df'),
+            'term_total': LexiconColumn(self, 'term_total'),
+            'posting_locs': PostingLocsColumn(self, 'loc'),
+            'posting_format': self.meta['posting_format'],
+            'impact_scale': self.meta['impact_scale'],
+        }
+        if 'posting_nbytes' in self.arrays:
+            variables['posting_nbytes'] = LexiconColumn(self, 'posting_nbytes')
+        if 'term_max' in self.arrays:
+            variables['term_max'] = TermMaxColumn(self, 'term_max')
+        if 'block_max' in self.arrays:
+            variables['block_max'] = RaggedColumn(self, 'block_max')
+        if 'impact_segments' in self.arrays:
+            variables['impact_segments'] = RaggedColumn(self, 'impact_segments')
+        return variables
+
+
+    # build a lexicon directory from an InvertedIndex (or anything with the same variables)
+    @staticmethod
+    def write(index, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        terms = list(index.df.keys())
+        hashes = np.array([term_hash(term) for term in terms], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        terms = [terms[i] for i in order.tolist()]
+        encoded = [term.encode('utf8') for term in terms]
+        
+        files = {}
+        locs = [index.posting_locs.get(term, []) for term in terms]
+        loc_files = np.array([files.setdefault(f_name, len(files)) for term_locs in locs for f_name, _ in term_locs], dtype=np.uint32)
+        arrays = {
+            'hashes': hashes[order],
+            'term_offsets': _starts([len(b) for b in encoded]),
+            'df': np.array([index.df[term] for term in terms], dtype=np.uint32),
+            'term_total': np.array([index.term_total.get(term, 0) for term in terms], dtype=np.uint64),
+            'loc_starts': _starts([len(term_locs) for term_locs in locs]),
+            'loc_files': loc_files,
+            'loc_offsets': np.array([offset for term_locs in locs for _, offset in term_locs], dtype=np.uint32),
+        }
+        
+        posting_nbytes = getattr(index, 'posting_nbytes', {})
+        if posting_nbytes:
+            arrays['posting_nbytes'] = np.array([posting_nbytes.get(term, 0) for term in terms], dtype=np.uint64)
+        term_max = getattr(index, 'term_max', {})
+        if term_max:
+            arrays['term_max'] = np.array([term_max.get(term, np.nan) for term in terms], dtype=np.float64)
+        block_max = getattr(index, 'block_max', {})
+        if block_max:
+            values = [block_max.get(term, np.zeros(0)) for term in terms]
+            arrays['block_max'] = np.concatenate(values).astype(np.float64)
+            arrays['block_max_starts'] = _starts([len(v) for v in values])
+        impact_segments = getattr(index, 'impact_segments', {})
+        if impact_segments:
+            values = [np.asarray(impact_segments.get(term, np.zeros((0, 2))), dtype=np.int64) for term in terms]
+            arrays['impact_segments'] = np.concatenate(values).reshape(-1, 2)
+            arrays['impact_segments_starts'] = _starts([len(v) for v in values])
+        
+        for name, array in arrays.items():
+            np.save(path / f'{name}.npy', array)
+        with open(path / 'terms.bin', 'wb') as f:
+            f.write(b''.join(encoded))
+        with open(path / 'files.json', 'w') as f:
+            json.dump(list(files), f)
+        with open(path / 'meta.json', 'w') as f:
+            json.dump({'posting_format': getattr(index, 'posting_format', 1),
+                       'impact_scale': getattr(index, 'impact_scale', 0.0)}, f)
+        
+        # document lengths, as a single-column DocStats
+        DL = index.DL
+        doc_ids = np.fromiter(DL.keys(), dtype=np.int64, count=len(DL))
+        order = np.argsort(doc_ids)
+        lengths = np.fromiter((DL[doc_id] for doc_id in doc_ids.tolist()), dtype=np.int32, count=len(doc_ids))
+        DocStats(doc_ids[order], {'dl': lengths[order]}).save(path / 'dl')
+
+
+
+#######################################################################################################################
+############################################## Lexicon View Classes ###################################################
+
+
+# read-only {term: value} view over a per-term lexicon array, used in place of an index's Counter / dict
+class LexiconColumn:
+    def __init__(self, lexicon, name):
+        self.lexicon = lexicon
+        self.name = name
+
+
+    def _value(self, row):
+        return self.lexicon.arrays[self.name][row].item()
+
+
+    def get(self, term, default=None):
+        row = self.lexicon.find(term)
+        return default if row < 0 else self._value(row)
+
+
+    def __getitem__(self, term):
+        row = self.lexicon.find(term)
+        if row < 0:
+            raise KeyError(term)
+        return self._value(row)
+
+
+    def __contains__(self, term):
+        return self.lexicon.find(term) >= 0
+
+
+    def __len__(self):
+        return len(self.lexicon)
+
+
+    def __iter__(self):
+        return self.lexicon.terms()
+
+
+    def keys(self):
+        return self
+
+
+    def items(self):
+        return ((self.lexicon.term(row), self._value(row)) for row in range(len(self.lexicon)))
+
+
+# term_max: terms without a bound (NaN) are missing
+class TermMaxColumn(LexiconColumn):
+    def get(self, term, default=None):
+        value = super().get(term, default)
+        return default if value is not None and np.isnan(value) else value
+
+
+    def __getitem__(self, term):
+        value = self.get(term)
+        if value is None:
+            raise KeyError(term)
+        return value
+
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+
+# ragged per-term arrays (block_max, impact_segments): terms with no entries are missing
+class RaggedColumn(LexiconColumn):
+    def _value(self, row):
+        start, end = self.lexicon.ragged(self.name, row)
+        return np.asarray(self.lexicon.arrays[self.name][start:end])
+
+
+    def get(self, term, default=None):
+        value = super().get(term, default)
+        return default if value is None or len(value) == 0 else value
+
+
+    def __getitem__(self, term):
+        value = self.get(term)
+        if value is None:
+            raise KeyError(term)
+        return value
+
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+
+# posting_locs: list of (file_name, offset) pairs per term
+class PostingLocsColumn(LexiconColumn):
+    def _value(self, row):
+        start, end = self.lexicon.ragged('loc', row)
+        files = self.lexicon.files
+        return [(files[f], int(offset)) for f, offset in zip(self.lexicon.arrays['loc_files'][start:end].tolist(),
+                                                             self.lexicon.arrays['loc_offsets'][start:end].tolist())]
+
+
+    def __getitem__(self, term):
+        row = self.lexicon.find(term)
+        return [] if row < 0 else self._value(row)
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+# convert a pickled index to a lexicon directory: python lexicon.py body_index.pkl body_index_lexicon
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python lexicon.py <index.pkl> <lexicon_dir>')
+    with open(sys.argv[1], 'rb') as f:
+        index = pickle.load(f)
+    Lexicon.write(index, sys.argv[2])
+    print(f'wrote {len(index.df)} terms to {sys.argv[2]}')
@@ -0,0 +1,213 @@
+#imports
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+import os
+import threading
+import time
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Metrics switch --- #
+# timers and counters cost a microsecond or two each and are on by default, IR_METRICS=0 turns them off
+ENABLED = os.environ.get('IR_METRICS', '1') == '1'
+
+# --- Histogram buckets --- #
+# upper bounds in seconds, from sub-millisecond cache hits up to cold reads of large posting lists
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# trace of the current request, see start_trace
+_trace = ContextVar('trace', default=None)
+
+
+
+#######################################################################################################################
+################################################# Metric Classes ######################################################
+
+
+# cumulative histogram per label values, rendered in the Prometheus text format
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # {label values: [count per bucket (the last one is +Inf), sum]}
+        self._series = {}
+        self._lock = threading.Lock()
+
+
+    def observe(self, value, labels=()):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+    def inc(self, value=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f'{self.name}{_labels(self.labelnames, labels)} {value}' for labels, value in values)
+        return lines
+
+
+# stage and event timings of one request, filled from the request thread and the retrieval pool
+class Trace:
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+
+    def add_duration(self, name, seconds):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+    # Server-Timing header value, durations in milliseconds and counts as descriptions
+    def server_timing(self):
+        with self._lock:
+            entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.durations.items()]
+            entries.extend(f'{name};desc="{value}"' for name, value in self.counts.items())
+        return ', '.join(entries)
+
+
+# times a stage of the current request, and adds it to the request's trace
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, (self.stage,))
+        trace = _trace.get()
+        if trace is not None:
+            trace.add_duration(self.stage, seconds)
+        return False
+
+
+
+#######################################################################################################################
+################################################ Process Metrics ######################################################
+
+
+# --- metrics of this process (every gunicorn worker exports its own) --- #
+STAGE_SECONDS = Histogram('ir_stage_seconds', 'Time spent in each stage of a search.', ('stage',))
+REQUEST_SECONDS = Histogram('ir_request_seconds', 'Time to answer a request, by route and status.', ('route', 'status'))
+COUNTERS = {
+    'posting_lists': Counter('ir_posting_lists_total', 'Posting lists looked up, by index and posting cache result.', ('field', 'cache')),
+    'posting_bytes': Counter('ir_posting_bytes_total', 'Encoded posting bytes read, by index.', ('field',)),
+    'posting_files': Counter('ir_posting_files_total', 'Posting files touched by reads, by index.', ('field',)),
+    'result_cache': Counter('ir_result_cache_total', 'Search result cache lookups, by result.', ('result',)),
+}
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+def _labels(labelnames, labels, **extra):
+    pairs = list(zip(labelnames, labels)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+# context manager timing a stage, like: with timer('tokenize'): ...
+def timer(stage):
+    if not ENABLED:
+        return nullcontext()
+    return _Timer(stage)
+
+
+# add to a counter of COUNTERS, the request's trace gets it under the name and label values, like posting_bytes_body
+def count(name, value=1, **labels):
+    if not ENABLED:
+        return
+    COUNTERS[name].inc(value, tuple(labels.values()))
+    trace = _trace.get()
+    if trace is not None:
+        trace.add_count('_'.join((name,) + tuple(labels.values())), value)
+
+
+# start tracing the current request, work submitted to other threads is traced when it runs in a copy of the context
+def start_trace():
+    if not ENABLED:
+        return None
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+def get_trace():
+    return _trace.get()
+
+
+def end_trace():
+    _trace.set(None)
+
+
+# numeric values of a stats dict (like BlockCache.stats()) as one gauge labeled by stat
+def render_stats(name, help, stats):
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+    lines.extend(f'{name}{{stat="{stat}"}} {value}' for stat, value in stats.items() if isinstance(value, (int, float)))
+    return lines
+
+
+# all metrics in the Prometheus text exposition format, followed by the lines of extra gauges
+def render(extra=()):
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render()
+    for counter in COUNTERS.values():
+        lines.extend(counter.render())
+    lines.extend(extra)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,149 @@
+#imports
+from collections import Counter
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Profiling --- #
+# seconds between stack samples, and entries kept in a profile summary
+SAMPLE_INTERVAL = 0.001
+TOP_FUNCTIONS = 30
+TOP_STACKS = 20
+
+# only one cProfile profiler can be active in a process at a time, profiled calls wait for each other
+_profile_lock = threading.Lock()
+
+
+
+#######################################################################################################################
+################################################ StackSampler Class ###################################################
+
+
+# samples the stack of one thread from a background thread, and counts the folded stacks
+# ("module:function;module:function ...", the format read by flamegraph tools)
+class StackSampler:
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self._fold(frame)] += 1
+
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+    # most sampled stacks, each with its share of the samples
+    def summary(self, n=TOP_STACKS):
+        total = sum(self.stacks.values())
+        return [{'stack': stack, 'samples': samples, 'share': samples / total} for stack, samples in self.stacks.most_common(n)]
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# top functions of a cProfile run by cumulative time
+def summarize_profile(profile, n=TOP_FUNCTIONS):
+    stats = pstats.Stats(profile)
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:n]
+    return [{'function': f"{os.path.basename(file_name)}:{line}({function})", 'calls': calls,
+             'tottime': tottime, 'cumtime': cumtime}
+            for (file_name, line, function), (primitive_calls, calls, tottime, cumtime, callers) in rows]
+
+
+# run fn() under cProfile and a stack sampler, returns (result, {'seconds', 'functions', 'stacks'}).
+# both only see the calling thread, so work to profile should run on it. concurrent calls run one at a time, the time
+# spent waiting for the others is in 'waited' and not in 'seconds'
+def profile_call(fn, *args, **kwargs):
+    queued = time.perf_counter()
+    with _profile_lock:
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        with StackSampler() as sampler:
+            profile.enable()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                profile.disable()
+        seconds = time.perf_counter() - start
+    return result, {'seconds': seconds, 'waited': start - queued, 'functions': summarize_profile(profile),
+                    'stacks': sampler.summary()}
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+# profile queries offline, the same way as /search?query=...&profile=1:
+#   IR_INDEX_DIR=/data/bucket python profiler.py queries.txt --out profile.json
+# queries.txt has one query per line, the report holds the explain and profile output of each
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Explain and profile search queries without the HTTP server.')
+    parser.add_argument('queries', help='file with one query per line')
+    parser.add_argument('--no-profile', dest='profile', action='store_false', help='only explain the queries')
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    # imported here, loading the frontend loads the indexes
+    import search_frontend
+    import metrics
+    # wait() returns False once the bootstrap failed, instead of blocking
+    if not search_frontend.bootstrap.wait():
+        sys.exit(f'index bootstrap failed: {search_frontend.bootstrap.errors}')
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    report = []
+    for query in queries:
+        # a trace per query, for its stage timings
+        metrics.start_trace()
+        report.append(dict(query=query, **search_frontend.explain_search(query, args.profile)))
+
+    # slowest queries first on stderr, the full report as JSON
+    for entry in sorted(report, key=lambda entry: -entry['explain']['seconds'])[:10]:
+        print(f"{entry['explain']['seconds'] * 1000:9.1f} ms  {entry['query']}", file=sys.stderr)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
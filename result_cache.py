@@ -0,0 +1,164 @@
+#imports
+from collections import OrderedDict
+from pathlib import Path
+import atexit
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Result cache settings --- #
+# memory budget, seconds an entry stays valid, and an optional file the cache is saved to at exit and loaded from
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('IR_RESULT_CACHE_MAX_BYTES', 64 * 2 ** 20))
+RESULT_CACHE_TTL = float(os.environ.get('IR_RESULT_CACHE_TTL', 600))
+RESULT_CACHE_PATH = os.environ.get('IR_RESULT_CACHE_PATH')
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# --- Version of the files an index is loaded from (sizes and modification times), missing paths are skipped --- #
+def file_version(paths):
+    h = hashlib.blake2b(digest_size=8)
+    for path in map(Path, paths):
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path] if path.exists() else []
+        for f in files:
+            st = f.stat()
+            h.update(f'{f}:{st.st_size}:{st.st_mtime_ns};'.encode('utf8'))
+    return h.hexdigest()
+
+
+
+#######################################################################################################################
+############################################### ResultCache Class #####################################################
+
+
+# LRU cache of search responses (bytes) with a byte budget and a TTL. entries belong to an index version and are all
+# dropped when the loaded version changes
+class ResultCache:
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL, path=RESULT_CACHE_PATH):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.version = None
+        # key -> (value, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+
+    @staticmethod
+    def _size(key, value):
+        return len(value) + len(repr(key))
+
+
+    # drop all entries when the index version changes
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._bytes = 0
+                self.version = version
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= self._size(key, value)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'expirations': self.expirations, 'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+    # save the unexpired entries with their version, so a restarted worker comes up warm
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            now = time.time()
+            state = {'version': self.version,
+                     'entries': [(key, value, expires_at) for key, (value, expires_at) in self._entries.items() if expires_at > now]}
+        # every worker saves at exit, each through its own temp file
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+    # entries of another version are dropped by the next set_version
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        now = time.time()
+        with self._lock:
+            self.version = state['version']
+            for key, value, expires_at in state['entries']:
+                size = self._size(key, value)
+                if expires_at > now and self._bytes + size <= self.max_bytes:
+                    self._entries[key] = (value, expires_at)
+                    self._bytes += size
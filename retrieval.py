@@ -0,0 +1,44 @@
+#imports
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import os
+import threading
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Retrieval concurrency --- #
+# field fetches in flight at once, shared by all requests of the process
+RETRIEVAL_WORKERS = int(os.environ.get('IR_RETRIEVAL_WORKERS', 16))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+
+#######################################################################################################################
+################################################ Helper Functions #####################################################
+
+
+# shared thread pool for posting list fetches, created on first use
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+        return _pool
+
+
+# runs the fetches of all fields ({field: fetch}, a fetch takes no arguments and reads all the posting lists the field
+# needs in one batch, returning {term: postings}) concurrently, and yields (field, {term: postings}) as each is done, so
+# fields are scored as their postings arrive. reading a field's terms together lets range reads of the same posting
+# file share requests (see MultiFileReader.read_many). each fetch runs in a copy of the caller's context, so its
+# timings land in the request's trace (see metrics.py)
+def fetch_fields(fields):
+    pool = get_pool()
+    futures = {pool.submit(contextvars.copy_context().run, fetch): field for field, fetch in fields.items()}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
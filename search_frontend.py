@@ -1,12 +1,25 @@
-from flask import Flask, request, jsonify
-from nltk.stem.porter import PorterStemmer
-from inverted_index import InvertedIndex
+from flask import Flask, Response, request, jsonify, g
+from inverted_index import InvertedIndex, BLOCK_CACHE, POSTING_CACHE, PINNED_TERMS
 import os
 import pickle
 import json
+import shutil
+import tempfile
 from backend import *
+import numpy as np
+from doc_stats import DocStats, DocLengths
+from bootstrap import Bootstrap, fetch, LOCAL_DIR
+from title_store import TitleStore
+from retrieval import fetch_fields
+from analyzer import get_analyzer
+from result_cache import ResultCache, file_version
+import fusion
+from functools import partial
+import time
+import metrics
+import profiler
+from metrics import timer
 import nltk
-from nltk.corpus import stopwords
 
 
 nltk.download('stopwords')
@@ -26,12 +39,36 @@ class MyFlaskApp(Flask):
 #######################################################################################################################
 ################################################# Helper Functions ####################################################
 
-# --- Load Index file --- #
+# --- Load Index file, or the lexicon directory converted from it (see lexicon.py) --- #
 def load_index(file_name):
+  if os.path.isdir(lexicon_dir(file_name)):
+    return InvertedIndex.read_lexicon(lexicon_dir(file_name))
   with open(file_name, 'rb') as file:
     return pickle.load(file)
 
 
+def lexicon_dir(file_name):
+  return file_name[:-len('.pkl')] + '_lexicon'
+
+
+def index_exists(file_name):
+  return os.path.exists(file_name) or os.path.isdir(lexicon_dir(file_name))
+
+
+# convert a pickled index to its lexicon directory. it is written next to it and renamed into place, so workers
+# loading at the same time never see a partial lexicon
+def convert_to_lexicon(file_name):
+  with open(file_name, 'rb') as file:
+    index = pickle.load(file)
+  tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(file_name)))
+  index.write_lexicon(tmp_dir)
+  try:
+    os.rename(tmp_dir, lexicon_dir(file_name))
+  except OSError:
+    # another worker converted it first
+    shutil.rmtree(tmp_dir)
+
+
 
 #######################################################################################################################
 ################################################# Initializations #####################################################
@@ -40,63 +77,275 @@ def load_index(file_name):
 # --- Bucket name --- #
 BUCKET_NAME = "ir_project__bucket1"
 
+# --- Artifacts converted from the downloaded files, kept next to them in LOCAL_DIR --- #
+DOC_STATS_DIR = os.path.join(LOCAL_DIR, 'doc_stats')
+TITLE_STORE_DIR = os.path.join(LOCAL_DIR, 'title_store')
+# files doc_stats is built from, it is built again when their version changes
+DOC_STATS_SOURCES = [os.path.join(LOCAL_DIR, f'{name}{suffix}') for name in ('body_index', 'title_index', 'anchor_index')
+                     for suffix in ('.pkl', '_lexicon')] + [os.path.join(LOCAL_DIR, 'pr.json')]
 
-# tokenizer and stopwords
-english_stopwords = frozenset(stopwords.words('english'))
-corpus_stopwords = ["category", "references", "also", "external", "links", 
-                    "may", "first", "see", "history", "people", "one", "two", 
-                    "part", "thumb", "including", "second", "following", 
-                    "many", "however", "would", "became"]
 
-all_stopwords = english_stopwords.union(corpus_stopwords)
-RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
+# tokenizer, stopwords and memoized stemmer, shared with the index builders (see analyzer.py)
+analyzer = get_analyzer()
 
-# stemmer
-ps = PorterStemmer()
+
+# fusion weights (body, title, anchor, page rank), a request can pass its own (see fusion.parse_weights)
+WEIGHTS = fusion.DEFAULT_WEIGHTS
+
+# body scoring: 'tfidf' (cosine similarity over the body index), or 'impact' (score-at-a-time evaluation over the
+# impact-ordered body index built by IndexBuilder.ipynb, see backend.get_body_impact_score)
+BODY_MODEL = os.environ.get('IR_BODY_MODEL', 'tfidf')
+
+# load the indexes as memory-mapped lexicons, converting the pickled ones on first load. serve.py turns this on, so
+# the workers share the index pages through the page cache instead of copying the pickled dicts
+USE_LEXICON = os.environ.get('IR_LEXICON', '0') == '1'
+
+# most queries accepted by /search_batch
+MAX_BATCH_QUERIES = 1000
 
 
 app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 
-# download all indexes
-if not os.path.exists('/Indexes/body_index.pkl'):
-  body_inv_index = InvertedIndex.read_index('body', 'body_index', BUCKET_NAME)
-else:
-  body_inv_index = load_index("/Indexes/body_index.pkl")
-  print("Body index file already exists.")
+# --- Startup artifacts, loaded concurrently in the background (see bootstrap.py) --- #
+def get_index(file_name, base_dir, name):
+  if index_exists(file_name):
+    print(f"{file_name} already exists.")
+  else:
+    file_name = str(fetch(BUCKET_NAME, f'{base_dir}/{name}.pkl', file_name))
+  if USE_LEXICON and not os.path.isdir(lexicon_dir(file_name)):
+    convert_to_lexicon(file_name)
+  return load_index(file_name)
+
+
+# per-document stats (DL of each index and page rank) in dense arrays, built from the indexes and pr.json. the saved
+# stats are loaded (without the indexes) while they are current, see doc_stats_current
+def get_doc_stats(body_inv_index=None, title_inv_index=None, anchor_inv_index=None):
+  if body_inv_index is None:
+    print("Doc stats are up to date.")
+    return DocStats.load(DOC_STATS_DIR)
+
+  with open(fetch(BUCKET_NAME, 'pr/pr.json', os.path.join(LOCAL_DIR, 'pr.json'))) as prJSON:
+    pr = json.load(prJSON)
 
-if not os.path.exists('/Indexes/title_index.pkl'):
-  title_inv_index = InvertedIndex.read_index('title', 'title_index', BUCKET_NAME)
-else:
-  title_inv_index = load_index("/Indexes/title_index.pkl")
-  print("Title index file already exists.")
+  doc_stats = DocStats.build({'body': body_inv_index.DL, 'title': title_inv_index.DL, 'anchor': anchor_inv_index.DL}, pr)
+  doc_stats.save(DOC_STATS_DIR, file_version(DOC_STATS_SOURCES))
+  return doc_stats
 
-if not os.path.exists('/Indexes/anchor_index.pkl'):
-  anchor_inv_index = InvertedIndex.read_index('anchor', 'anchor_index', BUCKET_NAME)
-else:
-  anchor_inv_index =  load_index("/Indexes/anchor_index.pkl")
-  print("Anchor index file already exists.")
 
+# whether the saved doc stats were built from the current index files and pr.json (sizes and modification times)
+def doc_stats_current():
+  return DocStats.saved_version(DOC_STATS_DIR) == file_version(DOC_STATS_SOURCES)
 
-# download page rank to pr varible
-if not os.path.exists('/Indexes/pr.json'):
-  os.system(f"gsutil cp gs://{BUCKET_NAME}/pr/pr.json .")
-else:
-  print("Page rank file already exists.")
 
-with open('/Indexes/pr.json') as prJSON:
-  pr = json.load(prJSON)
+# titles for each doc, converted once from titles.json to a memory-mapped title store
+def get_titles():
+  if os.path.exists(TITLE_STORE_DIR):
+    print("Title store already exists.")
+    return TitleStore.load(TITLE_STORE_DIR)
 
+  with open(fetch(BUCKET_NAME, 'titles/titles.json', os.path.join(LOCAL_DIR, 'titles.json'))) as titlesJSON:
+    TitleStore.build(json.load(titlesJSON)).save(TITLE_STORE_DIR)
+  return TitleStore.load(TITLE_STORE_DIR)
 
-# download titles for each doc 
-if not os.path.exists('titles.json'):
-  os.system(f"gsutil cp gs://{BUCKET_NAME}/titles/titles.json .")
-else:
-  print("Titles file already exists.")
 
-with open('titles.json') as titlesJSON:
-  titles = json.load(titlesJSON)
+# hot terms whose decoded posting lists stay in the posting cache, from the IR_PINNED_TERMS file ({ii_name: [terms]})
+def pin_terms(body_inv_index, title_inv_index, anchor_inv_index):
+  if not PINNED_TERMS:
+    return {}
+
+  with open(PINNED_TERMS) as pinnedJSON:
+    pinned = json.load(pinnedJSON)
+  for ii_name, index in [('body', body_inv_index), ('title', title_inv_index), ('anchor', anchor_inv_index)]:
+    index.pin_posting_lists(pinned.get(ii_name, []), ii_name, BUCKET_NAME)
+  return pinned
+
+
+# make the loaded artifacts the globals used by the routes
+def publish(artifacts):
+  global body_inv_index, title_inv_index, anchor_inv_index, impact_inv_index, doc_stats, titles
+  body_inv_index = artifacts['body_index']
+  impact_inv_index = artifacts.get('impact_index')
+  title_inv_index = artifacts['title_index']
+  anchor_inv_index = artifacts['anchor_index']
+  doc_stats = artifacts['doc_stats']
+  titles = artifacts['titles']
+
+  # cached results of other index files are dropped
+  result_cache.set_version(file_version(INDEX_FILES))
+
+  # the indexes read document lengths from doc_stats instead of their DL dicts
+  body_inv_index.DL = DocLengths(doc_stats, 'dl_body')
+  title_inv_index.DL = DocLengths(doc_stats, 'dl_title')
+  anchor_inv_index.DL = DocLengths(doc_stats, 'dl_anchor')
+  if impact_inv_index is not None:
+    impact_inv_index.DL = DocLengths(doc_stats, 'dl_body')
+
+
+# files the loaded indexes come from, their version invalidates the result cache
+INDEX_NAMES = ['body_index', 'title_index', 'anchor_index'] + (['impact_index'] if BODY_MODEL == 'impact' else [])
+INDEX_FILES = [path for name in INDEX_NAMES
+               for path in (os.path.join(LOCAL_DIR, f'{name}.pkl'), os.path.join(LOCAL_DIR, f'{name}_lexicon'))]
+INDEX_FILES += [DOC_STATS_DIR, TITLE_STORE_DIR]
+result_cache = ResultCache()
+
+bootstrap = Bootstrap()
+bootstrap.add('body_index', lambda: get_index(os.path.join(LOCAL_DIR, 'body_index.pkl'), 'body', 'body_index'))
+bootstrap.add('title_index', lambda: get_index(os.path.join(LOCAL_DIR, 'title_index.pkl'), 'title', 'title_index'))
+bootstrap.add('anchor_index', lambda: get_index(os.path.join(LOCAL_DIR, 'anchor_index.pkl'), 'anchor', 'anchor_index'))
+# doc stats are built from the DLs of the indexes, unless they were already saved
+bootstrap.add('doc_stats', get_doc_stats, deps=() if doc_stats_current() else ('body_index', 'title_index', 'anchor_index'))
+bootstrap.add('titles', get_titles)
+bootstrap.add('pinned_terms', pin_terms, deps=('body_index', 'title_index', 'anchor_index'))
+if BODY_MODEL == 'impact':
+  bootstrap.add('impact_index', lambda: get_index(os.path.join(LOCAL_DIR, 'impact_index.pkl'), 'impact', 'impact_index'))
+bootstrap.on_ready(publish)
+bootstrap.start()
+
+
+
+#######################################################################################################################
+################################################ Search Functions #####################################################
+
+
+# query tokens without stopwords, their stems, the body postings needed by the query ({term: blocks}), and all the
+# words of the query (the body is scored with them). the query is tokenized once. the impact body model reads its own
+# postings while scoring, so it needs none up front
+def analyze_query(query):
+  query_words = analyzer.words(query)
+  query_tokens = [token for token in query_words if token not in analyzer.stopwords]
+  stems = analyzer.stems(query_tokens)
+
+  if BODY_MODEL == 'impact':
+    return query_tokens, stems, {}, query_words
+  body_needed = get_needed_postings(query_words, body_inv_index, body_inv_index.term_total.keys())
+  return query_tokens, stems, body_needed, query_words
+
+
+# analyze_query, timed as the tokenize stage
+def tokenize_query(query):
+  with timer('tokenize'):
+    return analyze_query(query)
+
+
+# cached response body of the analyzed query searched with the weights, or None
+def get_cached(analyzed, weights=WEIGHTS):
+  res = result_cache.get(get_cache_key(analyzed, weights))
+  metrics.count('result_cache', result='miss' if res is None else 'hit')
+  return res
+
+
+# results are cached by the query tokens (lowercased, without stopwords, unstemmed) and the weights
+def get_cache_key(analyzed, weights=WEIGHTS):
+  return (tuple(analyzed[0]),) + tuple(weights)
+
+
+# {field: fetch} of the postings of all the analyzed queries, each field's posting lists are read in one batch and
+# each posting list is read once
+def get_fetches(analyzed_queries):
+  body_needed, stems, tokens = {}, {}, {}
+  for query_tokens, query_stems, query_body_needed, query_words in analyzed_queries:
+    body_needed.update(query_body_needed)
+    stems.update(dict.fromkeys(query_stems))
+    tokens.update(dict.fromkeys(query_tokens))
+  return {'body': partial(read_needed_postings, body_inv_index, body_needed),
+          'title': partial(title_inv_index.read_posting_arrays, list(stems), 'title', BUCKET_NAME),
+          'anchor': partial(anchor_inv_index.read_posting_arrays, list(tokens), 'anchor', BUCKET_NAME)}
+
+
+# top (doc_ids, scores) of one field for a query, postings ({term: postings}) may hold terms of other queries too
+def score_field(query, analyzed, field, postings):
+  query_tokens, stems, body_needed, query_words = analyzed
+  with timer(f'score_{field}'):
+    if field == 'body' and BODY_MODEL == 'impact':
+      return get_body_impact_score(query_words, impact_inv_index, 100)
+    if field == 'body':
+      return get_body_tfidf_score(query_words, body_inv_index, 100, {term: postings[term] for term in body_needed})
+    if field == 'title':
+      return get_binary_score(stems, postings, 100)
+    return get_binary_score(query_tokens, postings, 100)
+
+
+# fuse the field results ({field: (doc_ids, scores)}) with page rank, and return the top 100 doc ids
+def fuse_results(results, weights=WEIGHTS):
+  return fusion.fuse(results, doc_stats, weights)
+
+
+# the response body of the top doc ids, built from the stored, already escaped titles
+def render_results(doc_ids):
+  with timer('titles'):
+    return titles.render(doc_ids)
+
+
+# df, bytes and posting files of the terms of a field ({term: blocks}, see get_needed_postings)
+def explain_terms(index, terms):
+  explained = {}
+  for term, blocks in terms.items():
+    n_bytes, files = index.posting_extent(term, blocks)
+    explained[term] = {'df': int(index.df[term]) if term in index.df.keys() else 0, 'posting_bytes': int(n_bytes), 'files': files}
+    if blocks is not None:
+      explained[term]['blocks'] = len(blocks)
+  return explained
+
+
+# search a query without the result cache, and explain it: the terms read by each field, the body candidates before
+# and after the tf-idf cutoff, the weights and the score of each field for every result, and the stage timings. with
+# profile, the postings are fetched on the calling thread (so nothing is left out of the profile) and a profile summary
+# is added
+def explain_search(query, profile=False, weights=WEIGHTS):
+  start = time.perf_counter()
+  analyzed = tokenize_query(query)
+  query_tokens, stems, body_needed, query_words = analyzed
+  fetches = get_fetches([analyzed])
+
+  def retrieve():
+    if profile:
+      fetched = {field: fetch() for field, fetch in fetches.items()}
+    else:
+      fetched = dict(fetch_fields(fetches))
+    return fetched, {field: score_field(query, analyzed, field, postings) for field, postings in fetched.items()}
+
+  if profile:
+    (fetched, results), report = profiler.profile_call(retrieve)
+  else:
+    fetched, results = retrieve()
+  docs, components = fusion.get_components(results, doc_stats, weights)
+  top = fusion.rank(components)
+  res = json.loads(render_results(docs[top]))
+
+  # body terms skipped by their score bounds are listed too. the impact model reads (up to) the whole impact-ordered
+  # lists of the query terms
+  candidates = get_candidate_documents(query_words, body_inv_index, body_inv_index.term_total.keys(), fetched['body'])
+  if BODY_MODEL == 'impact':
+    body_terms = explain_terms(impact_inv_index, {term: None for term in dict.fromkeys(query_words) if term in impact_inv_index.df.keys()})
+  else:
+    body_terms = explain_terms(body_inv_index, body_needed)
+  for term in dict.fromkeys(query_words):
+    if term not in body_terms:
+      body_terms[term] = {'df': int(body_inv_index.df[term]) if term in body_inv_index.df.keys() else 0, 'skipped': True}
+
+  trace = metrics.get_trace()
+  explained = {
+    'seconds': time.perf_counter() - start,
+    'tokens': query_tokens,
+    'stems': stems,
+    'terms': {'body': body_terms,
+              'title': explain_terms(title_inv_index, dict.fromkeys(stems)),
+              'anchor': explain_terms(anchor_inv_index, dict.fromkeys(query_tokens))},
+    'body_candidates': {term: {'postings': len(fetched['body'][term][0]), f'above_{TFIDF_CUTOFF}': len(candidates[term][0])}
+                        for term in candidates},
+    'field_results': {field: len(field_results[0]) for field, field_results in results.items()},
+    'weights': dict(zip(fusion.FIELDS, weights)),
+    'body_model': BODY_MODEL,
+    'scores': [{'id': doc_id, 'score': sum(float(components[field][i]) for field in components),
+                **{field: float(components[field][i]) for field in components}}
+               for doc_id, i in zip(docs[top].tolist(), top.tolist())],
+    'timings': None if trace is None else {'durations': dict(trace.durations), 'counts': dict(trace.counts)},
+  }
+  if profile:
+    return {'results': res, 'explain': explained, 'profile': report}
+  return {'results': res, 'explain': explained}
 
 
 
@@ -121,108 +370,166 @@ def search():
   --------
     list of up to 100 search results, ordered from best to worst where each 
     element is a tuple (wiki_id, title).
+
+    With explain=1, returns {"results": [...], "explain": {...}} instead, 
+    where explain has the df, posting bytes and files of each term per field, 
+    the body candidates before and after the tf-idf cutoff, the score of each 
+    field for every result and the stage timings. profile=1 adds a cProfile 
+    and sampled stack summary of the request.
+
+    weights=body,title,anchor,pr (like weights=0.4,0.3,0.05,0.25) fuses the 
+    fields with these weights instead of the default ones.
   '''
   res = []
+  if not bootstrap.ready():
+    return jsonify(res), 503
   query = request.args.get('query', '')
   if len(query) == 0:
     return jsonify(res)
+  try:
+    weights = fusion.parse_weights(request.args.get('weights'), WEIGHTS)
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
   # BEGIN SOLUTION
 
-  # initialize weights
-  body_weight = 0.35
-  title_weight = 0.35
-  anchor_weight = 0.05
-  pr_weight = 0.25
-
-  # get tokens
-  query_tokens = [token.group() for token in RE_WORD.finditer(query.lower())]
-  query_tokens = [token for token in query_tokens if token not in all_stopwords]
-
-  # get body results
-  body_results = dict(get_body_tfidf_score(query, body_inv_index, 100))
-
-
-  # get title results
-  docs_and_scores_title = {}
-
-  stems = []
-  for token in query_tokens:
-    stems.append(ps.stem(token))
-
-  for token in stems:
-    docs_and_tfs = title_inv_index.read_posting_list(token, 'title', BUCKET_NAME)
-    for (doc,tf) in docs_and_tfs:
-        if doc not in docs_and_scores_title.keys():
-          docs_and_scores_title[doc] = 1 / len(stems)
-        else:
-          docs_and_scores_title[doc] = docs_and_scores_title[doc] + (1 / len(stems))
-  docs_and_scores_title_list = [(k, v) for k, v in docs_and_scores_title.items()]
-  title_results = dict(sorted(docs_and_scores_title_list, key = lambda x: x[1],reverse=True)[:100])
-
-  # get anchor results
-  docs_and_scores_anchor = {}
-  for token in query_tokens:
-    docs_and_tfs = anchor_inv_index.read_posting_list(token, 'anchor', BUCKET_NAME)
-    for (doc,tf) in docs_and_tfs:
-        if doc not in docs_and_scores_anchor.keys():
-          docs_and_scores_anchor[doc] = 1 / len(query_tokens)
-        else:
-          docs_and_scores_anchor[doc] = docs_and_scores_anchor[doc] + (1 / len(query_tokens))
-  docs_and_scores_anchor_list = [(k, v) for k, v in docs_and_scores_anchor.items()]
-  anchor_results = dict(sorted(docs_and_scores_anchor_list, key = lambda x: x[1],reverse=True)[:100])
-
-  # all candidates
-  all_candidate_docs = set(list(body_results.keys()) + list(title_results.keys()) + list(anchor_results.keys()))
-
-  #searching
-  docs_and_scores_final = dict()
-  # calculate variables used in searching
-  max_body = 1
-  if body_results.values():
-    max_body = max(body_results.values())
-
-  max_title = 1
-  if title_results.values():
-    max_title = max(title_results.values())
-
-  max_anchor = 1
-  if anchor_results.values():
-    max_anchor = max(anchor_results.values())
-
-  prs = []
-  for doc in all_candidate_docs:
-    if(str(doc) in pr.keys()):
-      prs.append(pr[str(doc)])
-
-  max_pr = max(prs)
-
-  # give score for each doc
-  for doc in all_candidate_docs:
-    body_score = 0
-    title_score = 0
-    anchor_score = 0
-    pr_score = 0
-
-    if(doc in body_results.keys()):
-      body_score = body_weight * (body_results[doc]/max_body)
-
-    if(doc in title_results.keys()):
-      title_score = title_weight * (title_results[doc]/max_title)
-
-    if(doc in anchor_results.keys()):
-      anchor_score = anchor_weight * (anchor_results[doc]/max_anchor)
-    
-    if(str(doc) in pr.keys()):
-      pr_score = pr_weight * (pr[str(doc)]/max_pr)
-      
-    docs_and_scores_final[doc] = body_score + title_score + anchor_score + pr_score
-
-  res = sorted(list(docs_and_scores_final.items()), key=lambda x: x[1], reverse=True)[:100]
-  res = list(map(lambda x: (str(x[0]), titles[str(x[0])]), res))
+  # opt-in explain / profile output, next to the results
+  if request.args.get('explain') == '1' or request.args.get('profile') == '1':
+    return jsonify(explain_search(query, profile=request.args.get('profile') == '1', weights=weights))
+
+  analyzed = tokenize_query(query)
+  res = get_cached(analyzed, weights)
+  if res is not None:
+    return Response(res, mimetype='application/json')
+
+  # fetch the postings of all fields concurrently, each field's terms in one batched read (see retrieval.py), and
+  # score each field once its postings have arrived
+  results = {}
+  with timer('retrieve'):
+    for field, postings in fetch_fields(get_fetches([analyzed])):
+      results[field] = score_field(query, analyzed, field, postings)
+
+  with timer('fusion'):
+    top = fuse_results(results, weights)
+  res = render_results(top)
+  result_cache.put(get_cache_key(analyzed, weights), res)
 
   # END SOLUTION
-  return jsonify(res)
-    
+  return Response(res, mimetype='application/json')
+
+
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+  ''' Returns the results of many queries at once. Each posting list needed 
+    by any of the queries is fetched and decoded once, and all queries are 
+    scored against the shared postings.
+
+    The request body is JSON like {"queries": ["hello world", "take on me"]}, 
+    with at most MAX_BATCH_QUERIES queries, and optionally the fusion weights 
+    of all of them, like "weights": [0.4, 0.3, 0.05, 0.25].
+  Returns:
+  --------
+    list with the results of each query, in order, every one of them like 
+    the results of /search.
+  '''
+  if not bootstrap.ready():
+    return jsonify([]), 503
+  payload = request.get_json(silent=True)
+  payload = payload if isinstance(payload, dict) else {}
+  queries = payload.get('queries')
+  if not isinstance(queries, list) or len(queries) > MAX_BATCH_QUERIES or not all(isinstance(query, str) for query in queries):
+    return jsonify({'error': f'expected {{"queries": [...]}} with at most {MAX_BATCH_QUERIES} queries'}), 400
+  try:
+    weights = fusion.parse_weights(payload.get('weights'), WEIGHTS)
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
+
+  # cached results first, the other queries are searched together
+  res = {}
+  pending = {}
+  for query in queries:
+    if len(query) == 0 or query in res or query in pending:
+      continue
+    analyzed = tokenize_query(query)
+    cached = get_cached(analyzed, weights)
+    if cached is not None:
+      res[query] = cached
+    else:
+      pending[query] = analyzed
+
+  with timer('fetch'):
+    fetched = dict(fetch_fields(get_fetches(pending.values())))
+  for query, analyzed in pending.items():
+    results = {field: score_field(query, analyzed, field, postings) for field, postings in fetched.items()}
+    with timer('fusion'):
+      top = fuse_results(results, weights)
+    res[query] = render_results(top)
+    result_cache.put(get_cache_key(analyzed, weights), res[query])
+
+  body = b'[' + b','.join(res[query].rstrip(b'\n') if len(query) else b'[]' for query in queries) + b']\n'
+  return Response(body, mimetype='application/json')
+
+
+
+@app.route("/healthz")
+def healthz():
+  ''' Liveness check: 200 while the process is up, 500 once loading a startup 
+    artifact has failed for good. The body has the state and load time of 
+    each artifact.
+  '''
+  return jsonify(bootstrap.status()), 500 if bootstrap.failed() else 200
+
+
+@app.route("/ready")
+def ready():
+  ''' Readiness check: 200 once all indexes and files are loaded and /search 
+    can answer, 503 before that.
+  '''
+  return jsonify(bootstrap.status()), 200 if bootstrap.ready() else 503
+
+
+@app.route("/stats")
+def stats():
+  ''' Hit rates and sizes of the result cache, the decoded posting cache and 
+    the posting block cache.
+  '''
+  return jsonify({'result_cache': result_cache.stats(), 'posting_cache': POSTING_CACHE.stats(),
+                  'block_cache': BLOCK_CACHE.stats()})
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+  ''' Stage timings, posting read counters and cache stats of this process, 
+    in the Prometheus text format. Under serve.py every worker answers with 
+    its own metrics.
+  '''
+  extra = (metrics.render_stats('ir_result_cache', 'Result cache stats.', result_cache.stats())
+           + metrics.render_stats('ir_posting_cache', 'Decoded posting cache stats.', POSTING_CACHE.stats())
+           + metrics.render_stats('ir_block_cache', 'Posting block cache stats.', BLOCK_CACHE.stats()))
+  return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+
+# --- every request is traced, its stage timings are returned in the Server-Timing header --- #
+@app.before_request
+def start_trace():
+  g.start = time.perf_counter()
+  g.trace = metrics.start_trace()
+
+
+@app.after_request
+def add_server_timing(response):
+  if 'start' not in g:
+    return response
+  seconds = time.perf_counter() - g.start
+  if g.trace is not None:
+    metrics.REQUEST_SECONDS.observe(seconds, (str(request.endpoint), str(response.status_code)))
+    response.headers['Server-Timing'] = ', '.join(filter(None, [g.trace.server_timing(), f'total;dur={seconds * 1000:.2f}']))
+  return response
+
+
+@app.teardown_request
+def end_trace(exc):
+  metrics.end_trace()
+
 
 
 #######################################################################################################################
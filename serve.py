@@ -0,0 +1,107 @@
+#imports
+import argparse
+import gc
+import importlib
+import os
+from gunicorn.app.base import BaseApplication
+from gunicorn.errors import HaltServer
+from inverted_index import BLOCK_CACHE, POSTING_CACHE
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Serving defaults --- #
+BIND = os.environ.get('IR_BIND', '0.0.0.0:8080')
+WORKERS = int(os.environ.get('IR_WORKERS', os.cpu_count() or 1))
+# each worker is threaded, posting fetches are I/O bound
+THREADS = int(os.environ.get('IR_THREADS', 8))
+TIMEOUT = int(os.environ.get('IR_TIMEOUT', 120))
+# serve the indexes from memory-mapped lexicons (see search_frontend.USE_LEXICON)
+LEXICON = os.environ.get('IR_LEXICON', '1') == '1'
+
+
+
+#######################################################################################################################
+############################################# SearchApplication Class #################################################
+
+
+# pre-fork gunicorn server for search_frontend. with preload, the master loads every index once and waits for the
+# bootstrap to finish before forking, so the workers start warm. the indexes are served from lexicons (converted from
+# the pickles on first load), so they are memory-mapped like the doc stats and title store (and the postings with the
+# mmap backend), and all workers read the same pages of the page cache. whatever else the master loaded (and the
+# pickled indexes with --pickles) is only shared copy-on-write: gc.freeze keeps the garbage collector from touching
+# its pages, but reference counting still copies the pages of the objects a worker reads, so pickled indexes end up
+# mostly copied into every worker.
+# SIGHUP reloads: the master loads the indexes again and replaces the workers gracefully
+class SearchApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        self.frontend = None
+        super().__init__()
+
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+
+    def load(self):
+        gc.unfreeze()
+        reloading = self.frontend is not None
+        if not reloading:
+            self.frontend = importlib.import_module('search_frontend')
+        else:
+            # posting files may have been replaced along with the indexes
+            BLOCK_CACHE.clear()
+            POSTING_CACHE.clear()
+            self.frontend = importlib.reload(self.frontend)
+        if self.cfg.preload_app:
+            if not self.frontend.bootstrap.wait():
+                reason = f'index bootstrap failed: {self.frontend.bootstrap.status()}'
+                # exit with 1 instead of forking workers that would answer 503 forever. gunicorn reports a RuntimeError
+                # of the first load and exits, on a reload the master halts and stops the running workers
+                if reloading:
+                    raise HaltServer(reason, 1)
+                raise RuntimeError(reason)
+            # objects loaded so far are never collected, so workers don't write to their pages
+            gc.freeze()
+        return self.frontend.app
+
+
+    # load again on SIGHUP, the new workers are forked from the reloaded state
+    def reload(self):
+        super().reload()
+        self.callable = None
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the search engine with a pool of gunicorn workers.')
+    parser.add_argument('--bind', default=BIND)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--timeout', type=int, default=TIMEOUT)
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='load the indexes in every worker instead of once in the master')
+    parser.add_argument('--pickles', dest='lexicon', action='store_false', default=LEXICON,
+                        help='load the pickled indexes instead of converting them to memory-mapped lexicons')
+    args = parser.parse_args()
+    # read by search_frontend when the application loads it
+    os.environ['IR_LEXICON'] = '1' if args.lexicon else '0'
+    
+    SearchApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': args.timeout,
+        'graceful_timeout': args.timeout,
+        'preload_app': args.preload,
+    }).run()
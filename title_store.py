@@ -0,0 +1,87 @@
+#imports
+from pathlib import Path
+import json
+import numpy as np
+
+
+
+#######################################################################################################################
+############################################### TitleStore Class ######################################################
+
+
+# titles in one blob of pre-escaped JSON strings, indexed by sorted wiki id -> offset and opened with mmap, so only the
+# titles of the returned results are ever read
+class TitleStore:
+    def __init__(self, doc_ids, offsets, blob):
+        # sorted wiki ids, the title of doc_ids[i] is blob[offsets[i]:offsets[i + 1]]
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.blob = blob
+
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+    # positions of doc_ids, raises KeyError for ids without a title
+    def _positions(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        positions = np.searchsorted(self.doc_ids, doc_ids)
+        positions[positions == len(self.doc_ids)] = 0
+        missing = self.doc_ids[positions] != doc_ids if len(self.doc_ids) else np.ones(len(doc_ids), dtype=bool)
+        if missing.any():
+            raise KeyError(int(doc_ids[missing][0]))
+        return positions
+
+
+    # title of doc_id as an escaped JSON string (bytes, with the quotes)
+    def raw(self, doc_id):
+        position = int(self._positions([doc_id])[0])
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1]])
+
+
+    def __getitem__(self, doc_id):
+        return json.loads(self.raw(int(doc_id)))
+
+
+    # JSON body of [[str(doc_id), title], ...] for doc_ids, in order, made by concatenating the stored titles
+    def render(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        positions = self._positions(doc_ids)
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[positions + 1].tolist()
+        items = [b'["%d",%s]' % (doc_id, self.blob[start:end])
+                 for doc_id, start, end in zip(doc_ids.tolist(), starts, ends)]
+        return b'[' + b','.join(items) + b']\n'
+
+
+    # save as a directory with the blob and its index
+    def save(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'doc_ids.npy', self.doc_ids)
+        np.save(path / 'offsets.npy', self.offsets)
+        with open(path / 'titles.bin', 'wb') as f:
+            f.write(self.blob)
+
+
+    # load a saved TitleStore, the blob is memory-mapped so workers share its pages
+    @staticmethod
+    def load(path):
+        path = Path(path)
+        doc_ids = np.load(path / 'doc_ids.npy', mmap_mode='r')
+        offsets = np.load(path / 'offsets.npy', mmap_mode='r')
+        blob = np.memmap(path / 'titles.bin', dtype=np.uint8, mode='r').data if offsets[-1] else b''
+        return TitleStore(doc_ids, offsets, blob)
+
+
+    # build from the titles dict ({str(doc_id): title})
+    @staticmethod
+    def build(titles):
+        doc_ids = np.fromiter((int(doc_id) for doc_id in titles.keys()), dtype=np.int64, count=len(titles))
+        order = np.argsort(doc_ids, kind='stable')
+        values = list(titles.values())
+        encoded = [json.dumps(values[i]).encode('ascii') for i in order.tolist()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return TitleStore(doc_ids[order], offsets, b''.join(encoded))
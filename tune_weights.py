@@ -0,0 +1,257 @@
+#imports
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import numpy as np
+import fusion
+
+
+
+#######################################################################################################################
+################################################ Global Variables #####################################################
+
+
+# --- Fields and metrics --- #
+# weights are (body, title, anchor, page rank), like the weights of fusion.py. metrics are those of
+# search_frontend_quality.py, averaged over the queries
+FIELDS = fusion.FIELDS
+METRICS = ('map10', 'precision10', 'recall10', 'r_precision', 'f1_30')
+IDEAL_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ideal.json')
+# default weights of the frontends, evaluated as the baseline
+CURRENT_WEIGHTS = fusion.DEFAULT_WEIGHTS
+
+# --- Search defaults --- #
+GRID_STEP = 0.05
+RANDOM_SAMPLES = 5000
+COORDINATE_STEPS = 21
+COORDINATE_ROUNDS = 10
+# weight vectors evaluated per pool task
+CHUNK_SIZE = 256
+
+# per-query field scores of a worker, see init_worker
+_field_scores = []
+
+# elementwise round(), like the measurement functions (np.round rounds some halves differently)
+_round = np.frompyfunc(round, 2, 1)
+
+
+
+#######################################################################################################################
+############################################### Field Score Functions #################################################
+
+
+# {query: (docs, components)} of the queries: the sorted candidates of each query and the normalized, unweighted
+# score of each field for them (a (len(FIELDS), len(docs)) array). the postings of all queries are fetched once
+def compute_field_scores(queries):
+    # imported here, loading the frontend loads the indexes
+    import search_frontend
+    from retrieval import fetch_fields
+    # wait() returns False once the bootstrap failed, instead of blocking
+    if not search_frontend.bootstrap.wait():
+        sys.exit(f'index bootstrap failed: {search_frontend.bootstrap.errors}')
+
+    analyzed = {query: search_frontend.analyze_query(query) for query in queries}
+    fetched = dict(fetch_fields(search_frontend.get_fetches(analyzed.values())))
+    field_scores = {}
+    for query in queries:
+        results = {field: search_frontend.score_field(query, analyzed[query], field, postings) for field, postings in fetched.items()}
+        docs, components = fusion.get_components(results, search_frontend.doc_stats, (1, 1, 1, 1))
+        field_scores[query] = (docs, np.stack([components[field] for field in FIELDS]))
+    return field_scores
+
+
+# cached field scores are kept in one .npz: the queries, the offsets of each query's candidates, and the concatenated
+# doc ids and components
+def save_field_scores(path, field_scores):
+    queries = list(field_scores)
+    sizes = [len(field_scores[query][0]) for query in queries]
+    np.savez(path, queries=np.array(queries, dtype=str), offsets=np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+             docs=np.concatenate([field_scores[query][0] for query in queries] + [np.zeros(0, dtype=np.int64)]),
+             components=np.concatenate([field_scores[query][1] for query in queries] + [np.zeros((len(FIELDS), 0))], axis=1))
+
+
+def load_field_scores(path):
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as f:
+        offsets = f['offsets']
+        return {query: (f['docs'][start:end], f['components'][:, start:end])
+                for query, start, end in zip(f['queries'].tolist(), offsets[:-1], offsets[1:])}
+
+
+# field scores of the queries from the cache, the missing ones are computed and added to it
+def get_field_scores(queries, path, refresh=False):
+    field_scores = {} if refresh else load_field_scores(path)
+    missing = [query for query in queries if query not in field_scores]
+    if missing:
+        print(f'computing field scores of {len(missing)} queries', file=sys.stderr)
+        field_scores.update(compute_field_scores(missing))
+        save_field_scores(path, field_scores)
+    return {query: field_scores[query] for query in queries}
+
+
+
+#######################################################################################################################
+################################################ Metric Functions #####################################################
+
+
+def round3(values):
+    return _round(values, 3).astype(np.float64)
+
+
+# metrics (a (len(weights), len(METRICS)) array) of one query for every weight vector, computed like the measurement
+# functions of search_frontend_quality.py over the top 100 results of each fusion. n_true is the number of distinct
+# relevant docs, n_judged the length of the judged list (R-precision cuts the results to it)
+def query_metrics(weights, components, relevant, n_true, n_judged):
+    n = min(components.shape[1], 100)
+    metrics = np.zeros((len(weights), len(METRICS)))
+    metrics[:, 2] = 1.0 if n_true == 0 else 0.0
+    if n == 0:
+        return metrics
+
+    # fused scores like fusion.rank, field by field in the same order
+    scores = weights[:, 0:1] * components[0]
+    for i in range(1, len(FIELDS)):
+        scores = scores + weights[:, i:i + 1] * components[i]
+    k = min(n, max(30, n_judged))
+    top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+    hits = relevant[top]
+    found = np.cumsum(hits, axis=1)
+
+    # MAP@10: mean precision at the relevant results of the top 10
+    n10 = min(n, 10)
+    precisions = found[:, :n10] / np.arange(1, n10 + 1)
+    n_hits = found[:, n10 - 1]
+    metrics[:, 0] = round3(np.where(n_hits > 0, (precisions * hits[:, :n10]).sum(axis=1) / np.maximum(n_hits, 1), 0))
+    metrics[:, 1] = round3(n_hits / n10)
+    if n_true:
+        metrics[:, 2] = round3(n_hits / n_true)
+        metrics[:, 3] = round3(found[:, min(n, n_judged) - 1] / n_judged)
+
+        # F1@30 of the rounded precision and recall at 30
+        n30 = min(n, 30)
+        p30 = round3(found[:, n30 - 1] / n30)
+        r30 = round3(found[:, n30 - 1] / n_true)
+        with np.errstate(divide='ignore'):
+            metrics[:, 4] = np.where((p30 > 0) & (r30 > 0), round3(2.0 / (1.0 / p30 + 1.0 / r30)), 0)
+    return metrics
+
+
+# per-query field scores and judgements of a worker process
+def init_worker(field_scores, qrels):
+    global _field_scores
+    _field_scores = []
+    for query, (docs, components) in field_scores.items():
+        true_docs = np.array(sorted({int(doc) for doc in qrels[query]}), dtype=np.int64)
+        _field_scores.append((components, np.isin(docs, true_docs), len(true_docs), len(qrels[query])))
+
+
+# mean metrics over all queries of each weight vector
+def evaluate(weights):
+    metrics = np.zeros((len(weights), len(METRICS)))
+    for components, relevant, n_true, n_judged in _field_scores:
+        metrics += query_metrics(weights, components, relevant, n_true, n_judged)
+    return metrics / max(len(_field_scores), 1)
+
+
+# evaluate the weight vectors in chunks across the pool
+def evaluate_all(pool, weights):
+    if len(weights) == 0:
+        return np.zeros((0, len(METRICS)))
+    chunks = np.array_split(weights, -(-len(weights) // CHUNK_SIZE))
+    return np.concatenate(list(pool.map(evaluate, chunks)))
+
+
+
+#######################################################################################################################
+################################################ Search Functions #####################################################
+
+
+# weight vectors on a grid of the simplex (the weights add up to 1, rankings don't change with their scale)
+def grid_weights(step=GRID_STEP):
+    n = int(round(1 / step))
+    weights = [(a, b, c, n - a - b - c) for a, b, c in itertools.product(range(n + 1), repeat=3) if a + b + c <= n]
+    return np.array(weights, dtype=np.float64) / n
+
+
+def random_weights(samples=RANDOM_SAMPLES, seed=0):
+    return np.random.default_rng(seed).dirichlet(np.ones(len(FIELDS)), samples)
+
+
+# coordinate ascent from the start weights: each round tries COORDINATE_STEPS values of every weight (the others keep
+# their proportions), and moves to the best vector found, until a round doesn't improve the metric
+def coordinate_ascent(pool, start, metric, steps=COORDINATE_STEPS, rounds=COORDINATE_ROUNDS):
+    best = np.asarray(start, dtype=np.float64) / np.sum(start)
+    all_weights = [best[None]]
+    all_metrics = [evaluate_all(pool, best[None])]
+    best_score = all_metrics[0][0, metric]
+    for _ in range(rounds):
+        candidates = []
+        for i in range(len(FIELDS)):
+            others = np.delete(best, i)
+            others = others / others.sum() if others.sum() > 0 else np.full(len(others), 1 / len(others))
+            for value in np.linspace(0, 1, steps):
+                candidates.append(np.insert(others * (1 - value), i, value))
+        candidates = np.array(candidates)
+        metrics = evaluate_all(pool, candidates)
+        all_weights.append(candidates)
+        all_metrics.append(metrics)
+        i = int(np.argmax(metrics[:, metric]))
+        if metrics[i, metric] <= best_score:
+            break
+        best, best_score = candidates[i], metrics[i, metric]
+    return np.concatenate(all_weights), np.concatenate(all_metrics)
+
+
+
+#######################################################################################################################
+##################################################### Main ############################################################
+
+
+# tune the fusion weights offline, field scores are computed once and cached:
+#   python tune_weights.py --search grid --step 0.05 --metric map10
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the fusion weights of search_frontend.py on judged queries.')
+    parser.add_argument('--qrels', default=IDEAL_QUERIES, help='JSON {query: [relevant wiki ids]}')
+    parser.add_argument('--cache', default='field_scores.npz', help='file of the cached field scores')
+    parser.add_argument('--refresh', action='store_true', help='compute the field scores again')
+    parser.add_argument('--search', choices=['grid', 'random', 'coordinate'], default='grid')
+    parser.add_argument('--step', type=float, default=GRID_STEP, help='grid step')
+    parser.add_argument('--samples', type=int, default=RANDOM_SAMPLES, help='random weight vectors')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metric', choices=METRICS, default='map10', help='metric to maximize')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--top', type=int, default=10, help='best weight vectors printed')
+    parser.add_argument('--out', help='write all evaluated weight vectors and their metrics as JSON')
+    args = parser.parse_args()
+
+    with open(args.qrels) as f:
+        qrels = json.load(f)
+    field_scores = get_field_scores(list(qrels), args.cache, args.refresh)
+    current = CURRENT_WEIGHTS
+    metric = METRICS.index(args.metric)
+
+    t_start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(field_scores, qrels)) as pool:
+        if args.search == 'coordinate':
+            weights, metrics = coordinate_ascent(pool, current, metric)
+        else:
+            weights = grid_weights(args.step) if args.search == 'grid' else random_weights(args.samples, args.seed)
+            weights = np.concatenate([np.array([current]), weights])
+            metrics = evaluate_all(pool, weights)
+    print(f'evaluated {len(weights)} weight vectors on {len(field_scores)} queries in {time.time() - t_start:.1f}s',
+          file=sys.stderr)
+
+    print(f"{'body':>6} {'title':>6} {'anchor':>6} {'pr':>6}  " + ' '.join(f'{name:>11}' for name in METRICS))
+    for i in [0] + np.argsort(-metrics[:, metric], kind='stable')[:args.top].tolist():
+        print(' '.join(f'{w:6.3f}' for w in weights[i]) + '  ' + ' '.join(f'{m:11.4f}' for m in metrics[i])
+              + ('  (current)' if i == 0 else ''))
+
+    if args.out:
+        order = np.argsort(-metrics[:, metric], kind='stable')
+        with open(args.out, 'w') as f:
+            json.dump([dict(zip(FIELDS + METRICS, weights[i].tolist() + metrics[i].tolist())) for i in order], f, indent=1)